@@ -0,0 +1,94 @@
+"""
+Runs main.py's init_context/handler locally, without nuclio, and reports how fast it is.
+Usage: python bench.py [folder of images] --batch 8 --requests 50
+Set the same environment variables as main.py to try out the ONNX backend or quiet mode. 
+"""
+
+import argparse
+import base64
+import io
+import os
+import time
+from types import SimpleNamespace
+import numpy as np
+from PIL import Image
+
+# Point main.py at the function.yaml next to it unless told otherwise
+HERE = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault("FUNCTION_YAML", os.path.join(HERE, "function.yaml"))
+import main
+
+class Logger:
+    def __init__(self, quiet):
+        self.quiet = quiet
+
+    def info(self, msg):
+        if not self.quiet:
+            print(msg)
+
+class Response:
+    # Same arguments as nuclio's Response
+    def __init__(self, body, headers, content_type, status_code):
+        self.body = body
+        self.status_code = status_code
+
+def load_frames(folder, count=16):
+    """ Base64 encodes the JPEGs in a folder, or makes up some noise if there's no folder. """
+    if folder:
+        names = sorted(name for name in os.listdir(folder) if name.lower().endswith((".jpg", ".jpeg", ".png")))
+        paths = [os.path.join(folder, name) for name in names[:count]]
+        raw = [open(path, "rb").read() for path in paths]
+    else:
+        rng = np.random.default_rng(0)
+        raw = []
+        for _ in range(count):
+            buf = io.BytesIO()
+            Image.fromarray(rng.integers(0, 255, (640, 640, 3), dtype=np.uint8)).save(buf, "JPEG")
+            raw.append(buf.getvalue())
+    return [base64.b64encode(img).decode() for img in raw]
+
+def run(folder=None, batch=1, requests=50, warmup=3, verbose=False):
+    """ Calls init_context once, then handler a number of times, returning latency percentiles and frames/s. """
+    context = SimpleNamespace(logger=Logger(not verbose), user_data=SimpleNamespace(), Response=Response)
+
+    # Time startup separately, since it includes loading the model and warming it up 
+    start = time.perf_counter()
+    main.init_context(context)
+    init_time = time.perf_counter() - start
+
+    # Build requests, cycling through the frames 
+    frames = load_frames(folder, max(batch, 16))
+    def event(i):
+        picked = [frames[(i * batch + j) % len(frames)] for j in range(batch)]
+        return SimpleNamespace(body={"images": picked} if batch > 1 else {"image": picked[0]})
+
+    # Warm up, then time each request
+    for i in range(warmup):
+        main.handler(context, event(i))
+    latencies = []
+    for i in range(requests):
+        start = time.perf_counter()
+        response = main.handler(context, event(i))
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "init_s": init_time,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "frames_per_s": batch * requests / (latencies.sum() / 1000),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("folder", nargs="?", help="Folder of images to send. Uses random noise if left out.")
+    parser.add_argument("--batch", type=int, default=1, help="Frames per request.")
+    parser.add_argument("--requests", type=int, default=50, help="Number of timed requests.")
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed requests to send first.")
+    parser.add_argument("--verbose", action="store_true", help="Show the handler's logs.")
+    args = parser.parse_args()
+
+    stats = run(args.folder, args.batch, args.requests, args.warmup, args.verbose)
+    print(f"init: {stats['init_s']:.2f}s  p50: {stats['p50_ms']:.1f}ms  p99: {stats['p99_ms']:.1f}ms  "
+          f"frames/s: {stats['frames_per_s']:.1f}")
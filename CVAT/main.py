@@ -1,12 +1,20 @@
 """
-Runs the yolov11 model I trained (best.pt) as a serverless nuclio task in CVAT. 
-Used to automatically generate annotations. 
-In this repo bc I don't want to fork CVAT :( 
+Runs the yolov11 model I trained (best.pt) as a serverless nuclio task in CVAT.
+Used to automatically generate annotations.
+In this repo bc I don't want to fork CVAT :(
+
+Settings (environment variables):
+    MODEL_BACKEND: "pytorch" to run best.pt (default) or "onnx" to run best.onnx. ONNX runs on the CPU, 
+        or on the GPU if onnxruntime-gpu is installed (IE with function-gpu.yaml).
+    MODEL_PATH: Path to the weights. Defaults to best.pt or best.onnx depending on the backend.
+    FUNCTION_YAML: Path to function.yaml, where the labels are read from.
+    QUIET: Set to 1 to stop logging every box.
 """
 
 import base64
 import io
 import json
+import os
 import yaml
 from PIL import Image
 import ultralytics as ua
@@ -15,41 +23,69 @@ def init_context(context):
     context.logger.info("Init context...  0%")
 
     # Read labels
-    with open("/opt/nuclio/function.yaml", 'rb') as function_file:
+    with open(os.environ.get("FUNCTION_YAML", "/opt/nuclio/function.yaml"), 'rb') as function_file:
         functionconfig = yaml.safe_load(function_file)
     labels_spec = functionconfig['metadata']['annotations']['spec']
 
     # Save labels to dict, store in context
     context.user_data.labels = {item['id']: item['name'] for item in json.loads(labels_spec)}
+    context.user_data.quiet = os.environ.get("QUIET", "0") == "1"
+
+    # Read the model. ONNX gets exported from the PyTorch weights if it isn't there already
+    backend = os.environ.get("MODEL_BACKEND", "pytorch")
+    if backend == "onnx":
+        model_path = os.environ.get("MODEL_PATH", "best.onnx")
+        if not os.path.exists(model_path):
+            context.logger.info(f"No {model_path}, exporting it from best.pt")
+            model_path = ua.YOLO("best.pt").export(format="onnx")
+        context.user_data.model = ua.YOLO(model_path, task="detect")
+    else:
+        context.user_data.model = ua.YOLO(os.environ.get("MODEL_PATH", "best.pt"))
+    context.logger.info("Init context... 50%")
 
-    # Read the model
-    context.user_data.model = ua.YOLO("best.pt")
+    # Warm up so that the first real request doesn't pay for setting everything up
+    blank = Image.new("RGB", (640, 640))
+    for _ in range(2):
+        context.user_data.model(blank, verbose=False)
     context.logger.info("Init context...100%")
 
 
 def handler(context, event):
-    context.logger.info("Run YoloV11 model")
+    if not context.user_data.quiet:
+        context.logger.info("Run YoloV11 model")
 
-    # Load image from event, converting to PIL image
+    # Load image(s) from event, converting to PIL images. A batch of frames comes in as a list under "images"
     data = event.body
-    buf = io.BytesIO(base64.b64decode(data["image"]))
-    image = Image.open(buf)
+    batch = "images" in data
+    encoded = data["images"] if batch else [data["image"]]
+    images = [Image.open(io.BytesIO(base64.b64decode(image))) for image in encoded]
+
+    # Run model on every frame at once
+    output = context.user_data.model(images, verbose=not context.user_data.quiet)
+
+    # Iterate through each frame's boxes, adding to a dictionary
+    frames = [to_results(context, frame.boxes) for frame in output]
 
-    # Run model
-    output = context.user_data.model(image)[0].boxes
+    # Send results as json in response. Batches get a list of results per frame
+    body = frames if batch else frames[0]
+    return context.Response(body=json.dumps(body), headers={},
+        content_type='application/json', status_code=200)
+
+def to_results(context, output):
+    # Move everything off the device in one go
+    confs = output.conf.cpu().numpy().tolist()
+    classes = output.cls.cpu().numpy().astype(int).tolist()
+    points = output.xyxy.cpu().numpy().tolist()
 
-    # Iterate through each result, adding to a dictionary
     results = []
-    for i in range(0, len(output.cls)):
+    for conf, cls, xyxy in zip(confs, classes, points):
         result = {
-            "confidence": str(output.conf[i].item()),
-            "label": context.user_data.labels[int(output.cls[i].item())],
-            "points": output.xyxy[i, :].cpu().numpy().tolist(),
+            "confidence": str(conf),
+            "label": context.user_data.labels[cls],
+            "points": xyxy,
             "type": "rectangle",
         }
         results.append(result)
-        context.logger.info(f"{result['label']}")
-
-    # Send results as json in response
-    return context.Response(body=json.dumps(results), headers={},
-        content_type='application/json', status_code=200)
+        if not context.user_data.quiet:
+            context.logger.info(f"{result['label']}")
+    return results
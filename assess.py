@@ -1,143 +1,563 @@
-from streetview import POI, Session
+from streetview import POI, Session, POIBatch
 import multipoint
-import geojson
-from models import BusStopAssess
+from detections import Detections, exp_score
 import json
-import numpy as np
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing as mp
+import hashlib
+import numpy as np
+import threading
+import queue
+import time
 import os 
 
 """
 The pipeline for automatically assessing bus stop completeness  
 """
 
-def pull_imgs(folder_path: str, geojson_path: str):
+def pull_imgs(folder_path: str, geojson_path: str, adaptive=False, ambiguous=(.1, .5), model_path="models/best.pt", 
+              pipeline=None):
     """
     Pull an image of every bus stop from a geojson file. 
+    Args:
+        adaptive: Capture just the main pic first, only adding the other vantage points if the model isn't sure about it.
+        ambiguous: Range of scores (see _score) from the main pic alone that count as unsure. 
+            A single pic scores (1 - e^-1) * conf at most, so anything at or above ~.63 can't happen.
+        model_path: Path to the model's weights, only used when adaptive.
+        pipeline: Number of threads for each stage of capturing (resolving, planning and pulling images), IE (4, 4, 8). 
+            See Session.capture_pipelined(). Leave as None to capture one stop at a time. Can't be used with adaptive.
     """
     # Create new sessions of the tools we're using 
+    from models import BusStopAssess
     sesh = Session(folder_path=folder_path, debug=True)
-    spacer = multipoint.Autoincrement("key.txt")
+    spacer = multipoint.Autoincrement("key.txt", tracker=sesh.tracker)
+    model = BusStopAssess(folder_path, model_path=model_path) if adaptive else None
+
+    # Capture every stop
+    for _ in _capture_stops(sesh, spacer, geojson_path, model=model, ambiguous=ambiguous, pipeline=pipeline):
+        pass
 
+    # Once complete, write log
+    sesh.write_log()
+
+def _capture_stops(sesh: Session, spacer, geojson_path: str, save=True, model=None, ambiguous=(.1, .5), pipeline=None):
+    """ 
+    Captures every bus stop in a geojson file, yielding each POI, its images and when its capture started. 
+    Adaptively captures the multipoints if given a model, otherwise pipelines the capture if given worker counts.
+    """
     # Open geojson record of stops 
+    import geojson
     with open(geojson_path) as f:
         stops = geojson.load(f)['features']
 
+    # Let the session run every stage of capturing at once 
+    if pipeline and model is None:
+        pois = (POI(id=stop["properties"]["Stop_ID"], lat=stop["geometry"]["coordinates"][1], 
+                    lon=stop["geometry"]["coordinates"][0]) for stop in stops)
+        yield from sesh.capture_pipelined(pois, spacer, (1,1), 6, 45, save, improve=True, verify_unique=True, 
+                                          workers=pipeline)
+        return
+
     # Iterate through stops
     for stop in stops:
         # Build POI
+        start = time.perf_counter()
         coords = stop["geometry"]["coordinates"]
         stop_id = stop["properties"]["Stop_ID"]
         poi = POI(id=stop_id, lat=coords[1], lon=coords[0])
 
         # Update coords, check if it's been used
-        if sesh.improve_coords(poi, True):
-            # Multipoint
+        if not sesh.improve_coords(poi, True):
+            continue
+
+        # Multipoint, then pull images
+        if model is None:
             spacer.determine_points(poi, (1,1), 6, 1)
-            # Pull image
-            sesh.capture_POI(poi, 45)
+            imgs = sesh.capture_POI(poi, 45, save=save)
+        else:
+            imgs = _adaptive_capture(sesh, spacer, model, poi, save, ambiguous)
+        yield poi, imgs, start
 
-    # Once complete, write log
-    sesh.write_log()
+def _adaptive_capture(sesh: Session, spacer, model: "BusStopAssess", poi: POI, save, ambiguous, floor=.05):
+    """ Captures a POI's main pic, only going back for more vantage points if the model isn't sure about what's in it. """
+    # Start with the main pic
+    spacer.determine_points(poi, (0,0), 6, 1)
+    imgs = sesh.capture_POI(poi, 45, save=save, commit=False)
+
+    # Score each label found in it as if it were the only pic 
+    keys = [(poi.id, pic.pic_number) for pic in poi.pics]
+    _, _, scores = model.infer_images(imgs, keys, floor).score(floor)
+
+    # Go for the rest if anything falls in the ambiguous range 
+    if np.any((scores >= ambiguous[0]) & (scores < ambiguous[1])):
+        num_pics = len(poi.pics)
+        spacer.determine_points(poi, (1,1), 6, 1)
+        imgs += sesh.capture_POI(poi, 45, save=save, pics=poi.pics[num_pics:], commit=False)
+
+    # Now that it's done, write it into the log
+    sesh.log.commit_entry(poi)
+    return imgs
+
+def _log_entry(poi: POI):
+    """ Builds the same entry for a POI that it would get in log.json. """
+    return {
+        "lat": poi.coords.lat,
+        "lon": poi.coords.lon,
+        "og_lat": poi.original_coords.lat if poi.original_coords else None,
+        "og_lon": poi.original_coords.lon if poi.original_coords else None,
+        "fov": poi.fov,
+        "place_id": poi.place_id,
+        "place_name": poi.place_name,
+        "errors": poi.error_messages(),
+        "pictures": [pic.to_dict() for pic in poi.pics]
+    }
+
+def stream(folder_path: str, geojson_path: str, min_conf=.4, save_imgs=False, queue_size=16, floor=.05, 
+           model_path="models/best.pt", adaptive=False, ambiguous=(.1, .5), pipeline=None):
+    """
+    Captures and assesses every bus stop in a geojson file in one go. Images are handed straight from 
+    the capture session to the model through a bounded queue, so stops are scored as they arrive 
+    instead of having to be written to disk and read back in by assess(). 
+    Args:
+        folder_path: Folder for the log, scores.json and detections.npz (and the images if they're saved).
+        geojson_path: Geojson file of stops to capture.
+        min_conf: Minimum confidence for a detection to count towards a score.
+        save_imgs: Whether to also save the images to folder_path. Lets assess() reuse these results later.
+        queue_size: Max number of captured stops waiting on the model. Keeps memory in check if capturing outpaces it. 
+        floor: Lowest confidence saved to detections.npz, IE the lowest min_conf rescore() can use.
+        model_path: Path to the model's weights.
+        adaptive, ambiguous: See pull_imgs(). The capture thread gets its own copy of the model for this.
+        pipeline: See pull_imgs().
+    Returns a dict of how long each stop took from the start of its capture to being scored, in seconds.
+    """
+    # Set up model and the queue that hands images over to it 
+    from models import BusStopAssess
+    model = BusStopAssess(folder_path, model_path=model_path)
+    captured = queue.Queue(maxsize=queue_size)
+    floor = min(floor, min_conf)
+
+    # Capture in the background. The session has to be made in the same thread that uses its log.
+    # If capturing fails, hold onto the error so it can be raised here instead of looking like the end of the stops
+    failed = []
+    os.makedirs(folder_path, exist_ok=True)
+
+    # Set once the model side is done, IE because scoring failed, so that capturing doesn't wait on a full queue forever
+    stopping = threading.Event()
+    def hand_over(item):
+        while not stopping.is_set():
+            try:
+                captured.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-def _assess(stops, model, min_conf=.4):
-    # Run the model on the entire folder
-    output = model.infer_log(stops, False, min_conf)
+    def capture():
+        sesh = None
+        try:
+            sesh = Session(folder_path=folder_path, debug=True)
+            spacer = multipoint.Autoincrement("key.txt", tracker=sesh.tracker)
+            checker = BusStopAssess(folder_path, model_path=model_path) if adaptive else None
+            for item in _capture_stops(sesh, spacer, geojson_path, save_imgs, checker, ambiguous, pipeline):
+                if not hand_over(item):
+                    return
+            sesh.write_log()
+        except BaseException as e:
+            failed.append(e)
+        finally:
+            # Close the log if it never got written out, then let the model know there's nothing left
+            if getattr(sesh, "log", None) is not None:
+                sesh.log.db_connect.close()
+            hand_over(None)
+    capturer = threading.Thread(target=capture, daemon=True)
+    capturer.start()
 
-    # Iterate through each POI, scoring likelihood of category being present
+    # Score each stop as soon as its images show up. The detections are only a few numbers per box, 
+    # so they're kept for one save at the end
+    detections = Detections()
+    latencies = {}
+    try:
+        with ScoreWriter(os.path.join(folder_path, "scores.json")) as writer:
+            item = captured.get()
+            while item is not None:
+                poi, imgs, start = item
+                # Skip any image that failed to pull
+                pairs = [(img, (poi.id, pic.pic_number)) for pic, img in zip(poi.pics, imgs) if img is not None]
+                poi_dets = model.infer_images([img for img, _ in pairs], [key for _, key in pairs], floor)
+                writer.write(_score({str(poi.id): _log_entry(poi)}, poi_dets, min_conf))
+                detections.extend(poi_dets)
+                latencies[poi.id] = time.perf_counter() - start
+                item = captured.get()
+            capturer.join()
+            model.flush()
+            if failed:
+                raise failed[0]
+    finally:
+        # Stop capturing too if scoring failed, and wait for its log to close
+        stopping.set()
+        capturer.join()
+
+    # Save the raw detections next to the log. If the images were saved too, 
+    # write down which ones these came from so that assess() won't rerun them
+    detections.save(os.path.join(folder_path, DETECTIONS_FILE), floor)
+    if save_imgs:
+        with open(os.path.join(folder_path, "log.json")) as f:
+            stops = json.load(f)
+        images, _, _ = _plan(stops, folder_path, _hash_file(model_path), {}, Detections())
+        with open(os.path.join(folder_path, MANIFEST_FILE), "w") as f:
+            json.dump({"floor": floor, "images": images}, f)
+
+    return latencies
+
+# Names of the files that raw detections and the record of what's been inferred are saved to, next to the log
+DETECTIONS_FILE = "detections.npz"
+MANIFEST_FILE = "manifest.json"
+
+def _assess(stops, model, min_conf=.4, floor=.05, todo=None, known=None, batch_size=1, cache=None):
+    """ 
+    Scores a set of stops, also returning the Detections table the scores came from.
+    Args:
+        todo: The stops (and pics) that still need to be run through the model. Defaults to all of them.
+        known: Detections from previous runs for the rest of the stops' pics.
+        batch_size: Images per run of the model. 0 runs them all at once.
+        cache: A TensorCache to feed the model already letterboxed images from.
+    """
+    detections = Detections()
+    if known is not None:
+        detections.extend(known)
+
+    # Run the model on whatever's left. Keep everything above the floor so we can rescore later
+    if todo is None:
+        todo = stops
+    if todo:
+        detections.extend(model.infer_log(todo, batch_size != 1, min(floor, min_conf), batch_size=batch_size, 
+                                           cache=cache, output_conf=min_conf))
+
+    # Score likelihood of each category being present for every POI
+    return _score(stops, detections, min_conf), detections
+
+def _score(stops, detections, min_conf=.4, score_fn=exp_score):
+    """ Builds the scores dict for a set of stops from their Detections table. """
+    # Score every (POI, label) pair at once 
+    poi_idx, label_ids, label_scores = detections.score(min_conf, score_fn)
+
+    # Sort the scores into a dict of labels for each POI 
+    poi_scores = defaultdict(dict)
+    for poi, label, score in zip(poi_idx.tolist(), label_ids.tolist(), label_scores.tolist()):
+         poi_scores[poi][detections.labels[label]] = score
+
+    # Add some of the POI's info from the log. Every stop with pictures gets an entry, even if nothing was found
     scores = {}
-    for id in output:
-         
-         # Each POI has a dict of labels
-         poi_output = output[id]
-         poi_scores = defaultdict()
-
-         # Go through each class 
-         for label in poi_output:
-              
-              # See if this label was detected 
-              if label in poi_output:
-                   # See how many pics this label was found in. Finding it in multiple pics gives big % boost 
-                   num_pics = len(poi_output[label])
-
-                   # Find the highest conf for each pic, sum them 
-                   label_sum = np.sum([np.max(confs) for confs in poi_output[label]])
-
-                   # Total score is the sum of predictions over number of pics, times log function of # pic occurences
-                   total_score = (1 - np.exp(-num_pics)) * (label_sum / num_pics)
-
-                   # Add to this label in the dict
-                   poi_scores[label] = total_score
-
-         # Add some of the POI's info from the log 
-         poi_dict = {
+    for id in stops:
+         if not stops[id]["pictures"]:
+              continue
+         i = detections.poi_index(id)
+         scores[id] = {
               'latitude': stops[id]["lat"],
               'longitude': stops[id]["lon"],
               'latitude_og': stops[id]["og_lat"],
               'longitude_og': stops[id]["og_lon"],
               'gmaps_place_name': stops[id]["place_name"],
-              'amenity_scores': poi_scores 
+              'amenity_scores': poi_scores[i]
          }
 
-         # Add POI's results to dict
-         scores[id] = poi_dict
-
     return scores
 
+# Each worker process keeps its own copy of the model (and tensor cache), loaded once by _init_worker
+_worker_model = None
+_worker_cache = None
+
+def _init_worker(input_folder, output_folder, num_threads, model_path, output_every, use_cache=False):
+    """ Loads a model into a pool worker, pinning torch's thread count so workers don't fight over cores. """
+    global _worker_model, _worker_cache
+    import torch
+    from models import BusStopAssess
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+    _worker_model = BusStopAssess(input_folder, output_folder, model_path, output_every)
+    if use_cache:
+        from tensor_cache import TensorCache
+        _worker_cache = TensorCache(input_folder, readonly=True)
+
+def _assess_shard(args):
+    """ Scores one shard of stops using this worker's model. """
+    shard, min_conf, floor, todo, known, batch_size = args
+    results = _assess(shard, _worker_model, min_conf, floor, todo, known, batch_size, _worker_cache)
+
+    # Make sure annotated images are done saving before the pool can shut this worker down
+    _worker_model.flush()
+    return results
+
+def _hash_file(path):
+    """ Hashes a file's contents. Returns None if the file doesn't exist. """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+def _load_known(input_folder, floor):
+    """ Opens the manifest and detections from previous runs. Ignores them if they were saved with a higher floor. """
+    manifest_path = os.path.join(input_folder, MANIFEST_FILE)
+    detections_path = os.path.join(input_folder, DETECTIONS_FILE)
+    if not (os.path.exists(manifest_path) and os.path.exists(detections_path)):
+        return {}, Detections()
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get("floor", 1) > floor:
+        return {}, Detections()
+    return manifest.get("images", {}), Detections.load(detections_path)
+
+def _plan(stops, input_folder, model_hash, manifest, known):
+    """ 
+    Sorts out which pics need to go through the model, IE those that are new, changed, or were inferred by an older model. 
+    Images are only hashed again if their size or modified time has changed since the manifest was written.
+    Returns the updated manifest, the stops/pics that need inferring, and a mask of rows in known that are still good.
+    """
+    images = {}
+    todo = {}
+    reused = []
+    for stop_id in stops:
+        stop = stops[stop_id]
+        for pic in stop["pictures"]:
+            # See if this image is the same one, run through the same model, as last time  
+            key = f"{stop_id}_{pic['pic_number']}"
+            path = f"{input_folder}/{key}.jpg"
+            old = manifest.get(key, {})
+            if os.path.exists(path):
+                stat = os.stat(path)
+                entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+                same_file = old.get("hash") and (old.get("size"), old.get("mtime")) == (stat.st_size, stat.st_mtime_ns)
+                entry.update(hash=old["hash"] if same_file else _hash_file(path), model=model_hash)
+            else:
+                entry = {"hash": None, "model": model_hash}
+            images[key] = entry
+            if entry["hash"] and (old.get("hash"), old.get("model")) == (entry["hash"], model_hash):
+                reused.append((stop_id, pic["pic_number"]))
+                continue
+
+            # Otherwise add it to the to-do list, keeping the rest of the stop's info
+            if stop_id not in todo:
+                todo[stop_id] = dict(stop, pictures=[])
+            todo[stop_id]["pictures"].append(pic)
+
+    # Only keep the old detections that came from images that are being reused 
+    pic_span = 1 << 16
+    index = {poi_id: i for i, poi_id in enumerate(known.poi_ids)}
+    reused_keys = [index[stop_id] * pic_span + pic for stop_id, pic in reused if stop_id in index]
+    row_keys = known.poi.astype(np.int64) * pic_span + known.pic
+    return images, todo, np.isin(row_keys, reused_keys)
+
+class ScoreWriter:
+    """
+    Writes scores.json one chunk at a time, so that only the chunk being scored has to be held in memory.
+    Output goes to a .part file that replaces the real one on close(), so a crash never leaves a broken scores.json.
+    Use it in a with block so that the .part file gets cleaned up if something goes wrong.
+    """
+    def __init__(self, path:str):
+        self.path = path
+        # The folder might be new, IE an output_folder nothing else has written to yet
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(f"{path}.part", "w", encoding="utf-8")
+        self.file.write("{")
+        self.empty = True
+
+    def write(self, scores:dict):
+        """ Appends a chunk of scores, one stop per line. """
+        for id in scores:
+            self.file.write("\n  " if self.empty else ",\n  ")
+            self.file.write(f"{json.dumps(id)}: {json.dumps(scores[id])}")
+            self.empty = False
+
+    def close(self):
+        self.file.write("\n}\n")
+        self.file.close()
+        os.replace(f"{self.path}.part", self.path)
+
+    def abort(self):
+        """ Throws away everything written so far, leaving any existing scores.json alone. """
+        self.file.close()
+        os.remove(f"{self.path}.part")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
 def make_chunks(stops, chunk_size):
     items = list(stops.items())
     for i in range(0, len(items), chunk_size):
         yield dict(items[i:i + chunk_size])
 
-def assess(input_folder:str, output_folder:str = None, min_conf=.4, chunk_size=0):
+def assess(input_folder:str, output_folder:str = None, min_conf=.4, chunk_size=0, workers=0, floor=.05, 
+           incremental=True, model_path="models/best.pt", output_every=1, model=None, batch_size=1, 
+           tensor_cache=False, model_hash=None):
     """
     Runs each of the images pulled from the prior step through the model, 
     generating a json file containing the likelihood 'score' of each amenity for each stop.
     Uses the log generated from the streetview pulling process to find images. 
+    Args:
+        input_folder: Folder containing both the log and the images.
+        output_folder: Where to save scores.json (and annotated images). Defaults to input_folder.
+        min_conf: Minimum confidence for a detection to count towards a score.
+        chunk_size: Number of stops to run through the model at a time. 0 runs them all at once.
+        workers: Number of processes to run the model in, each with its own copy of the model. 
+            0 or 1 runs everything in this process.
+        floor: Lowest confidence saved to detections.npz (next to the log), IE the lowest min_conf rescore() can use.
+        incremental: Only run the model on images that are new, have changed, or were inferred by a different model 
+            since the last run. Everything else reuses the detections saved last time. 
+            Not used when saving annotated images to output_folder, since only the rerun images would get them.
+        model_path: Path to the model's weights. 
+        output_every: When saving annotated images to output_folder, only save every nth one.
+        model: An already loaded BusStopAssess to use instead of loading one from model_path, IE from daemon.py. 
+            It has to be pointed at input_folder. Ignores workers.
+        batch_size: Images per run of the model. 0 runs each chunk all at once.
+        tensor_cache: Keep decoded, letterboxed images in a memory-mapped file next to the log (about 1.2MB per image) 
+            and feed the model from it, so that later runs with other weights or thresholds skip decoding the JPEGs.
+            Not used when saving annotated images to output_folder, since those have to come from the originals.
+        model_hash: Hash of the weights at model_path, if it's already known. Saves rereading them every run.
     """
     # Open the log 
     log_path = os.path.join(input_folder, "log.json")
     with open(log_path) as f:
             stops = json.load(f)
-
-    # Set up YOLO model 
-    model = BusStopAssess(input_folder, output_folder)
     
     # Set save path to output folder if provided 
     save_path = input_folder
     if output_folder:
         save_path = output_folder
 
+    # Figure out which pics actually need to go through the model
+    floor = min(floor, min_conf)
+    incremental = incremental and not output_folder
+    manifest, known = _load_known(input_folder, floor) if incremental else ({}, Detections())
+    if model_hash is None:
+        model_hash = _hash_file(model_path)
+    images, todo, still_good = _plan(stops, input_folder, model_hash, manifest, known)
+    known = known.select(still_good)
+    known_index = {poi_id: i for i, poi_id in enumerate(known.poi_ids)}
+
+    # Get anything that isn't in the cache yet decoded up front, so the model never waits on a JPEG
+    cache = None
+    if tensor_cache and todo and not output_folder:
+         from tensor_cache import TensorCache
+         cache = TensorCache(input_folder)
+         cache.update(todo, input_folder)
+         cache.save()
+
     # Only run the model on a finite number of stops bc WSL keeps crashing :(
     if not chunk_size: 
          chunk_size = len(stops)
-    chunks = make_chunks(stops, chunk_size)
-
-    # Run model on each chunk
-    temp_files = []
-    for i, chunk in enumerate(chunks): 
-         
-         # Plug this chunk into the model
-         chunk_scores = _assess(chunk, model, min_conf)
-         
-         # Save results to a temp JSON file
-         chunk_path = os.path.join(save_path, f"temp_{i}.json")
-         temp_files.append(chunk_path)
-         with open(chunk_path, "w") as f: 
-              json.dump(chunk_scores, f, indent=2)
-
-    # Merge all temp JSON files into one final JSON
-    final_scores = {}
-    for file in temp_files:
-        with open(file, "r") as f:
-            chunk_data = json.load(f)
-            final_scores.update(chunk_data)
-
-    # Save the final combined results
-    final_path = os.path.join(save_path, "scores.json")
-    with open(final_path, "w") as f:
-        json.dump(final_scores, f, indent=2)
-
-    # Delete temp JSON files
-    for file in temp_files:
-        os.remove(file)
\ No newline at end of file
+         # Use a few shards per worker so that one slow shard doesn't hold up the others
+         if workers > 1:
+              chunk_size = max(1, -(-len(stops) // (workers * 4)))
+
+    # Give each chunk its to-do list and the detections we already have for it
+    def jobs():
+         for chunk in make_chunks(stops, chunk_size):
+              chunk_todo = {id: todo[id] for id in chunk if id in todo}
+              rows = [known_index[id] for id in chunk if id in known_index]
+              yield chunk, min_conf, floor, chunk_todo, known.select(np.isin(known.poi, rows)), batch_size
+
+    # Run model on each chunk, either in this process or across a pool of workers, 
+    # writing each chunk's scores out as soon as they're ready. Don't bother loading the model if nothing changed.
+    # Detections are only a few numbers per box, so every chunk's are kept for one save at the end
+    detections = Detections()
+    with ScoreWriter(os.path.join(save_path, "scores.json")) as writer:
+        if workers > 1 and todo and model is None:
+            # Split the cores evenly between workers. Spawn so that each worker gets a clean torch.
+            # If a worker can't load the model, the pool breaks and raises instead of hanging
+            num_threads = max(1, (os.cpu_count() or 1) // workers)
+            pool = ProcessPoolExecutor(workers, mp_context=mp.get_context("spawn"), initializer=_init_worker, 
+                                       initargs=(input_folder, output_folder, num_threads, model_path, output_every, 
+                                                 cache is not None))
+            try:
+                for future in as_completed([pool.submit(_assess_shard, job) for job in jobs()]):
+                    chunk_scores, chunk_dets = future.result()
+                    writer.write(chunk_scores)
+                    detections.extend(chunk_dets)
+            finally:
+                # Don't wait on the rest of the chunks if one failed
+                pool.shutdown(cancel_futures=True)
+        else:
+            # Set up YOLO model 
+            if model is None and todo:
+                from models import BusStopAssess
+                model = BusStopAssess(input_folder, output_folder, model_path, output_every)
+            for job in jobs(): 
+                # Plug this chunk into the model
+                chunk_scores, chunk_dets = _assess(job[0], model, *job[1:], cache=cache)
+                writer.write(chunk_scores)
+                detections.extend(chunk_dets)
+            if model:
+                model.flush()
+
+    # Keep the raw detections with the log so that we never have to rerun the model just to rescore, 
+    # along with a record of which images (and model) they came from
+    detections.save(os.path.join(input_folder, DETECTIONS_FILE), floor)
+    with open(os.path.join(input_folder, MANIFEST_FILE), "w") as f:
+        json.dump({"floor": floor, "images": images}, f)
+
+def rescore(input_folder:str, output_folder:str = None, min_conf=.4, score_fn=exp_score):
+    """
+    Recomputes scores.json from the detections saved by assess(), without loading the model.
+    Args:
+        input_folder: Folder containing the log and detections.npz.
+        output_folder: Where to save scores.json. Defaults to input_folder.
+        min_conf: Minimum confidence for a detection to count towards a score. Can't go below the floor assess() used.
+        score_fn: Takes arrays of # pics and mean max conf for each stop's labels, returns their scores. 
+    """
+    # Open the log and the detections saved next to it
+    with open(os.path.join(input_folder, "log.json")) as f:
+        stops = json.load(f)
+    detections = Detections.load(os.path.join(input_folder, DETECTIONS_FILE))
+
+    # Anything under the floor was never kept, so scoring below it would quietly leave those boxes out. 
+    # Older detections don't know their floor, but the manifest might
+    floor = detections.floor
+    manifest_path = os.path.join(input_folder, MANIFEST_FILE)
+    if floor is None and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            floor = json.load(f).get("floor")
+    if floor is not None and min_conf < floor:
+        raise ValueError(f"min_conf of {min_conf} is under the floor of {floor} the detections were saved with. "
+                         "Rerun assess() with a lower floor first.")
+
+    # Score everything at once, save results
+    save_path = output_folder if output_folder else input_folder
+    with ScoreWriter(os.path.join(save_path, "scores.json")) as writer:
+        writer.write(_score(stops, detections, min_conf, score_fn))
+
+def refresh(folder_path:str, key_path="key.txt", run_assess=True, session_args=None, **assess_args):
+    """
+    Brings an earlier capture up to date, IE for a quarterly refresh. Every pic's metadata gets pulled again, 
+    but images are only pulled again where the pano has changed (a new pano ID or capture date). 
+    The log is rewritten, and then only the new images get run through the model since assess() is incremental. 
+    Everything else is carried forward from the last run.
+    Args:
+        folder_path: Folder with the earlier capture's log.json and images.
+        run_assess: Whether to assess() the folder afterwards. 
+        session_args: Passed to the Session, IE base_url and retries.
+        assess_args: Passed to assess(). Incremental unless said otherwise.
+    Returns the number of pics that were pulled again.
+    """
+    # Read in the old log before the session overwrites it 
+    with open(os.path.join(folder_path, "log.json")) as f:
+        stops = POIBatch.from_log(json.load(f))
+
+    # Check every stop's pics, only pulling what's changed
+    sesh = Session(folder_path=folder_path, key_path=key_path, debug=True, **(session_args or {}))
+    changed = 0
+    for poi in stops:
+        changed += len(sesh.refresh_POI(poi))
+    sesh.write_log()
+
+    if run_assess:
+        assess_args.setdefault("incremental", True)
+        assess(folder_path, **assess_args)
+    return changed
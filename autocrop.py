@@ -1,174 +1,243 @@
 import os 
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
 from cv2 import imread, imwrite
 import numpy as np
+import struct
+import shutil
+import subprocess
+
+# Used for lossless cropping, if it's installed 
+JPEGTRAN = shutil.which("jpegtran")
 
-@dataclass 
-class Box:
-    # Image dimensions 
-    img_w: int 
-    img_h: int 
-
-    # Class of box 
-    label: int 
-
-    # Yolo boundaries
-    center_x: float
-    center_y: float
-    box_w: float
-    box_h: float
-
-    def to_pixels(self):
-        # Convert from YOLO format to pixels
-        center_x = self.center_x * self.img_w
-        center_y = self.center_y * self.img_h
-        box_width = self.box_w * self.img_w
-        box_height = self.box_h * self.img_h
-        
-        # Calculate the top-left and bottom-right corners of the bounding box
-        self.x1 = int(center_x - box_width / 2)
-        self.y1 = int(center_y - box_height / 2)
-        self.x2 = int(center_x + box_width / 2)
-        self.y2 = int(center_y + box_height / 2)
-
-    def fight(self, lightweight, heavyweight):
-        # idk man
-        return min(lightweight, self.x1), max(heavyweight, self.x2)
-    
-    def adjust_bounds(self, left_bound, right_bound):
-        # New width of cropped image
-        new_w = right_bound - left_bound
-
-        # Adjust x coordinates relative to the cropped region
-        new_x1 = self.x1 - left_bound
-        new_x2 = self.x2 - left_bound
-
-        # Convert to YOLO format 
-        self.to_yolo(new_x1, new_x2, new_w)
-    
-    def to_yolo(self, x1, x2, w):
-        self.new_box_x = ((x1 + x2) / 2) / w
-        self.new_box_y = ((self.y1 + self.y2) / 2) / self.img_h 
-        self.new_width = (x2 - x1) / w
-        self.new_box_h = self.box_h 
-
-    def paste(self, changed = True):
-        return f"{self.label} {self.new_box_x} {self.new_box_y} {self.new_width} {self.box_h}"
-    
 def make_folder(folder_path, name):
     da_path = f"{folder_path}/{name}"
     if not os.path.exists(da_path):
         os.makedirs(da_path)
     return da_path
 
-def run(path:str, optimal_width=640, max_width=800, min_padding=50):
-    # Make cropped folder
+def image_size(path):
+    """
+    Reads an image's (width, height) from its header without decoding it. Handles JPEGs and PNGs.
+    Returns None for anything else.
+    """
+    header = read_header(path)
+    return header[:2] if header else None
+
+def read_header(path):
+    """
+    Reads an image's header without decoding it. Handles JPEGs and PNGs.
+    Returns (width, height, MCU width), where MCU width is the width of the JPEG's blocks 
+    (IE 16 for 4:2:0 chroma subsampling) or None if it isn't a JPEG. Returns None for anything else.
+    """
+    with open(path, "rb") as f:
+        start = f.read(24)
+
+        # PNG keeps its size in the first chunk
+        if start[:8] == b"\x89PNG\r\n\x1a\n":
+            return struct.unpack(">II", start[16:24]) + (None,)
+
+        # JPEGs have to be walked marker by marker until we hit a start of frame
+        if start[:2] != b"\xff\xd8":
+            return None
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            # Skip fill bytes
+            while marker[1] == 0xFF:
+                marker = marker[1:] + f.read(1)
+            length = struct.unpack(">H", f.read(2))[0]
+
+            # SOF0 through SOF15, minus the ones that aren't frames (DHT, JPG, DAC)
+            if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                height, width, num_components = struct.unpack(">xHHB", f.read(6))
+
+                # Each component has an ID, sampling factors and a table. MCUs are 8px times the biggest horizontal factor
+                components = f.read(3 * num_components)
+                h_factor = max(components[i] >> 4 for i in range(1, len(components), 3))
+                return width, height, 8 * h_factor
+            f.seek(length - 2, 1)
+
+def save_crop(src, dst, img, left, right, img_h):
+    """
+    Saves columns [left, right) of an image. If the image hasn't been decoded (img is None), crops it losslessly 
+    with jpegtran, in which case left should be a multiple of its MCU width. Falls back to decoding and slicing.
+    """
+    if img is None:
+        result = subprocess.run([JPEGTRAN, "-copy", "all", "-crop", f"{right - left}x{img_h}+{left}+0", 
+                                 "-outfile", dst, src], capture_output=True)
+        if result.returncode == 0:
+            return
+        img = imread(src)
+    imwrite(dst, img[:, left:right])
+
+def read_labels(label_path):
+    """ Reads a YOLO label file into an (n, 5) array of label, center x, center y, width, height. """
+    with open(label_path, 'r') as file:
+        return np.array(file.read().split(), dtype=np.float64).reshape(-1, 5)
+
+def load_labels(label_dir, file_names):
+    """ 
+    Reads a whole folder's worth of label files into one (n, 5) array. 
+    Also returns the row each file starts at, with one extra on the end for where the last one stops.
+    """
+    arrays = [read_labels(f"{label_dir}/{file_name}") for file_name in file_names]
+    starts = np.cumsum([0] + [len(array) for array in arrays])
+    return (np.concatenate(arrays) if arrays else np.empty((0, 5))), starts
+
+def plan_crops(labels, starts, widths, heights, mcus, optimal_width=640, max_width=800, min_padding=50):
+    """
+    Works out how to crop a batch of images, all at once.
+    Args:
+        labels, starts: Every image's boxes, from load_labels().
+        widths, heights: Each image's size.
+        mcus: Each image's crops have to start at a multiple of this. 1 for no restriction.
+    Returns a dict of arrays: "split" (whether each image gets split in two), "left"/"right" (the crop's bounds, or the 
+    midpoint for splits), plus each box's relabeled rows under "boxes" and which side of a split it went to under "side".
+    """
+    # Convert every box from YOLO standard to pixel coords 
+    file_idx = np.repeat(np.arange(len(widths)), np.diff(starts))
+    img_w, img_h = widths[file_idx], heights[file_idx]
+    center_x, center_y = labels[:, 1] * img_w, labels[:, 2] * img_h
+    box_w, box_h = labels[:, 3] * img_w, labels[:, 4] * img_h
+    x1 = (center_x - box_w / 2).astype(np.int64)
+    y1 = (center_y - box_h / 2).astype(np.int64)
+    x2 = (center_x + box_w / 2).astype(np.int64)
+    y2 = (center_y + box_h / 2).astype(np.int64)
+
+    # Find each image's min and max x. idk man
+    min_x = widths.astype(np.int64)
+    max_x = np.zeros(len(widths), np.int64)
+    np.minimum.at(min_x, file_idx, x1)
+    np.maximum.at(max_x, file_idx, x2)
+
+    # See which images need to be split, find midpoint between images. 
+    # Has to line up with the JPEG's blocks if cropping losslessly
+    window = max_x - min_x
+    split = window > max_width
+    midpoint = widths // 2
+    midpoint = np.where(midpoint >= mcus, midpoint - midpoint % mcus, midpoint)
+
+    # The number of pixels to be added to accomodate padding. If the space needed exceeds optimal width, 
+    # make sure it's less than max. Otherwise find space needed to fill optimal width 
+    desired_space = window + min_padding * 2
+    margin = np.where(desired_space > optimal_width, 
+                      np.where(desired_space > max_width, max_width - desired_space, min_padding * 2),
+                      optimal_width - window)
+
+    # Find new image bounds 
+    left = (min_x - margin / 2).astype(np.int64)
+    right = (max_x + margin / 2).astype(np.int64)
+
+    # Check if the area surpasses the width of the image, redistribute if so
+    under = left < 0
+    right = np.where(under, right - left, right)
+    left = np.where(under, 0, left)
+
+    # Check if if the area is less than the width of the image, redistribute if so
+    over = right > widths
+    left = np.where(over, left - (right - widths), left)
+    right = np.where(over, widths, right)
+
+    # Lossless crops have to start on a block, so widen the crop to the left if needed 
+    left -= left % mcus
+
+    # Splits go from 0 to the midpoint and the midpoint to the edge
+    left = np.where(split, midpoint, left)
+    right = np.where(split, widths, right)
+
+    # Relabel. Boxes in a split go on the right if they start past the midpoint. idk figure it out yourself im tired
+    side = split[file_idx] & (x1 < midpoint[file_idx])
+    offset = np.where(side, 0, left[file_idx])
+    new_w = np.where(side, midpoint[file_idx], right[file_idx] - left[file_idx])
+    boxes = np.column_stack([
+        labels[:, 0],
+        ((x1 - offset + x2 - offset) / 2) / new_w,
+        ((y1 + y2) / 2) / img_h,
+        (x2 - x1) / new_w,
+        labels[:, 4]])
+
+    return {"split": split, "left": left, "right": right, "boxes": boxes, "side": np.where(side, "left", "right")}
+
+def paste(boxes):
+    """ Formats rows of boxes back into the lines of a YOLO label file. """
+    return "".join(f"{int(row[0])} {row[1]} {row[2]} {row[3]} {row[4]}\n" for row in boxes.tolist())
+
+def write_labels(path, boxes):
+    # One buffered write per file
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(paste(boxes))
+
+def run(path:str, optimal_width=640, max_width=800, min_padding=50, workers=None, lossless=False):
+    """
+    Crops every image in path/images based on the boxes in path/labels, saving them to a '_cropped' folder next to path.
+    Args:
+        workers: Number of processes to crop with. Defaults to the number of cores.
+        lossless: Crop JPEGs without re-encoding them (needs jpegtran). Crops get widened on the left to line up 
+            with the JPEG's blocks, and labels are adjusted to match. Anything that can't be done this way gets re-encoded.
+    """
+    lossless = lossless and JPEGTRAN is not None
+
+    # Make cropped folders once up front 
     cropped_path = make_folder(os.path.dirname(path), f"{os.path.basename(path)}_cropped")
+    img_path = make_folder(cropped_path, "images")
+    label_path = make_folder(cropped_path, "labels")
 
-    # Go through folder, reading each file 
+    # Go through folder, checking the size of each image from its header. 
+    # Skip ones that are already narrow enough without bothering to decode them
+    todo, sizes = [], []
     for file_name in os.listdir(f"{path}/labels"):
-        # Open image 
         image_name = file_name.replace("txt", "jpg")
-        img = imread(f"{path}/images/{image_name}")
-        img_h, img_w = img.shape[:2]
-
-        # Continue to next iteration if size is already good 
-        if img_w <= optimal_width:
-            continue 
-
-        # Gotta put a comment here bc otherwise it'll look ugly 
-        boxes = []
-        min_x = img_w
-        max_x = 0
-
-        # Open labels file, step through each line to read boxes
-        with open(f"{path}/labels/{file_name}", 'r') as file: 
-            for line in file.readlines(): 
-                # Create box 
-                coords = line.strip().split()
-                box = Box(img_w, img_h, coords[0], 
-                          float(coords[1]), float(coords[2]), float(coords[3]), float(coords[4]))
-
-                # Convert from YOLO standard to pixel coords 
-                box.to_pixels()
-
-                # See if this box has min or max 
-                min_x, max_x = box.fight(min_x, max_x)
-                boxes.append(box)
-        
-        # See if image needs to be split
-        window = max_x-min_x
-        if window > max_width:
-            # Find midpoint between images
-            midpoint = img_w // 2 
-
-            # split the image into left and right
-            left_img = img[:, 0:midpoint]
-            right_img = img[:, midpoint:img_w]
-
-            # Save images
-            img_path = make_folder(cropped_path, "images")
-            imwrite(f"{img_path}/left_{image_name}", left_img)
-            imwrite(f"{img_path}/right_{image_name}", right_img)
-
-            # Relabel. idk figure it out yourself im tired 
-            label_path = make_folder(cropped_path, "labels")
-            right_boxes = []
-            left_boxes = []
-            [right_boxes.append(box) for box in boxes if box.x1 >= midpoint]
-            [left_boxes.append(box) for box in boxes if box.x1 < midpoint]
-
-            with open(f"{label_path}/right_{file_name}", 'w', encoding='utf-8') as file:
-                for box in right_boxes:
-                    box.adjust_bounds(midpoint, img_w)
-                    file.write(box.paste() + '\n')
-
-            with open(f"{label_path}/left_{file_name}", 'w', encoding='utf-8') as file:
-                for box in left_boxes:
-                    box.to_yolo(box.x1, box.x2, midpoint)
-                    file.write(box.paste() + '\n')
-                    
+        header = read_header(f"{path}/images/{image_name}")
+
+        # Only decode images whose header can't be read
+        if header is None:
+            img_h, img_w = imread(f"{path}/images/{image_name}").shape[:2]
+            header = (img_w, img_h, None)
+        if header[0] <= optimal_width:
+            continue
+        todo.append(file_name)
+        sizes.append(header)
+
+    # Read every label file and plan out every crop in one go
+    labels, starts = load_labels(f"{path}/labels", todo)
+    widths = np.array([size[0] for size in sizes], np.int64)
+    heights = np.array([size[1] for size in sizes], np.int64)
+    jpegs = np.array([lossless and size[2] is not None for size in sizes], bool)
+    mcus = np.array([size[2] if jpeg else 1 for size, jpeg in zip(sizes, jpegs)], np.int64)
+    plan = plan_crops(labels, starts, widths, heights, mcus, optimal_width, max_width, min_padding)
+
+    # Hand the images out to a pool of processes in chunks to keep overhead down
+    jobs = []
+    for i, file_name in enumerate(todo):
+        image_name = file_name.replace("txt", "jpg")
+        left, right = int(plan["left"][i]), int(plan["right"][i])
+        if plan["split"][i]:
+            crops = [(f"{img_path}/left_{image_name}", 0, left), (f"{img_path}/right_{image_name}", left, right)]
         else:
-            # The number of pixels to be added to accomodate padding 
-            desired_space = window + min_padding*2
-
-            # If the space needed exceeds optimal width, make sure it's less than max 
-            if desired_space > optimal_width:
-                if desired_space > max_width:
-                    margin = max_width - desired_space
-                else:
-                    margin = min_padding*2
-
-            # Otherwise find space needed to fill optimal width 
-            else: 
-                margin = optimal_width - window
-
-            # Find new image bounds 
-            left_bound = int(min_x - margin/2) 
-            right_bound = int(max_x + margin/2)
-
-            # Check if the area surpasses the width of the image, redistribute if so
-            if left_bound < 0:
-                right_bound += 0-left_bound
-                left_bound = 0
-
-            # Check if if the area is less than the width of the image, redistribute if so
-            if right_bound > img_w:
-                left_bound -= right_bound-img_w
-                right_bound = img_w
-
-            # Slice image to new bounds
-            img = img[:, left_bound:right_bound]
-
-            # Save image 
-            img_path = make_folder(cropped_path, "images")
-            imwrite(f"{img_path}/{image_name}", img)
-
-            # Writes new bounds into a txt file
-            label_path = make_folder(cropped_path, "labels")
-            with open(f"{label_path}/{file_name}", 'w', encoding='utf-8') as file:
-                for box in boxes:
-                    box.adjust_bounds(left_bound, right_bound)
-                    file.write(box.paste() + '\n')
-
-run("/home/dev/src/bus-stop-assess/datasets/others")
+            crops = [(f"{img_path}/{image_name}", left, right)]
+        jobs.append((f"{path}/images/{image_name}", crops, int(heights[i]), bool(jpegs[i])))
+
+    with ProcessPoolExecutor(workers) as pool:
+        cropping = pool.map(_crop, *zip(*jobs), chunksize=64) if jobs else []
+
+        # Meanwhile, write new bounds into txt files
+        for i, file_name in enumerate(todo):
+            boxes = plan["boxes"][starts[i]:starts[i + 1]]
+            if plan["split"][i]:
+                side = plan["side"][starts[i]:starts[i + 1]]
+                write_labels(f"{label_path}/left_{file_name}", boxes[side == "left"])
+                write_labels(f"{label_path}/right_{file_name}", boxes[side == "right"])
+            else:
+                write_labels(f"{label_path}/{file_name}", boxes)
+        list(cropping)
+
+def _crop(src, crops, img_h, lossless):
+    """ Saves each (path, left, right) crop of an image. Lossless crops don't need it decoded. """
+    img = None if lossless else imread(src)
+    for dst, left, right in crops:
+        save_crop(src, dst, img, left, right, img_h)
+
+if __name__ == "__main__":
+    run("/home/dev/src/bus-stop-assess/datasets/others")
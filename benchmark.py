@@ -0,0 +1,343 @@
+"""
+Benchmarks for the capturing tools. Runs against mock_maps.py and fake OSM roads, so nothing costs quota.
+Usage: 
+    python benchmark.py capture --stops 50 --latency .05 --workers 8
+    python benchmark.py geometry --stops 200 --profile
+    python benchmark.py imports
+"""
+import argparse
+import cProfile
+import math
+import pstats
+import subprocess
+import sys
+import tracemalloc
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from types import SimpleNamespace
+import numpy as np
+from mock_maps import MockMaps
+
+# Roughly how many meters are in a degree of latitude
+METERS_PER_DEGREE = 111_320
+
+# What gets imported to start up each way of running things. Python on its own is the baseline
+IMPORT_PATHS = {
+    "python": "pass",
+    "capture": "import streetview, multipoint",
+    "rescore": "import assess",
+    "assess": "import assess, models",
+}
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def synthetic_stops(num_stops, origin=(33.7756, -84.3963), spacing=40):
+    """ Makes (lat, lon, id) for stops every spacing meters, heading east from origin. """
+    lat, lon = origin
+    step = spacing / (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+    return [(lat, lon + i * step, f"stop_{i}") for i in range(num_stops)]
+
+# Kinds of road synthetic_roads() can make
+ROAD_KINDS = ("straight", "curved", "segments")
+
+def synthetic_roads(bbox, kind="straight"):
+    """
+    Makes fake OSM roads in a bounding box, in the same format as ox.features_from_bbox().
+    There's always a cross street too, so that _get_road() has to pick the right one.
+    Args:
+        bbox: (west, south, east, north), like _get_road() asks for.
+        kind: What the road the stop sits on looks like. It runs east to west a few meters south of the box's center.
+            straight: One named segment.
+            curved: One named segment that wiggles, with lots of vertices.
+            segments: Four unnamed segments with the same tiger:name_base, which have to be merged.
+    """
+    import geopandas as gpd
+    from shapely.geometry import LineString
+    west, south, east, north = bbox
+    lat = (south + north) / 2 - 7 / METERS_PER_DEGREE
+    cross_lon = west + (east - west) * .8
+    cross = LineString([(cross_lon, south), (cross_lon, north)])
+
+    if kind == "straight":
+        roads = [("Mock St", "Mock", LineString([(west, lat), (east, lat)]))]
+    elif kind == "curved":
+        lons = np.linspace(west, east, 200)
+        lats = lat + 20 / METERS_PER_DEGREE * np.sin(np.linspace(0, 4 * math.pi, 200))
+        roads = [("Mock St", "Mock", LineString(zip(lons, lats)))]
+    elif kind == "segments":
+        lons = np.linspace(west, east, 5)
+        roads = [(None, "Mock", LineString([(lons[i], lat), (lons[i + 1], lat)])) for i in range(4)]
+    else:
+        raise ValueError(f"Unknown kind of road: {kind}")
+
+    roads.append(("Cross St", "Cross", cross))
+    names, bases, lines = zip(*roads)
+    return gpd.GeoDataFrame({"name": names, "tiger:name_base": bases, "geometry": lines}, crs="EPSG:4326")
+
+@contextmanager
+def fake_osm(kind="straight"):
+    """ Swaps multipoint's OSM lookups out for synthetic_roads() until the block ends. """
+    import multipoint
+    real = multipoint.ox
+    multipoint.ox = SimpleNamespace(features_from_bbox=lambda bbox, tags: synthetic_roads(bbox, kind))
+    try:
+        yield
+    finally:
+        multipoint.ox = real
+
+class FakeMetadata:
+    """ Stands in for Requests when only metadata is needed, snapping to the same pano grid as MockMaps without a server. """
+    def __init__(self, pano_spacing=.0001):
+        self.maps = MockMaps(pano_spacing=pano_spacing)
+
+    def pull_pano_info(self, pic, poi):
+        from streetview import Coord
+        metadata = self.maps.metadata({"location": repr(pic.coords)})
+        pic.coords = Coord(metadata["location"]["lat"], metadata["location"]["lng"])
+        pic.pano_id = metadata["pano_id"]
+        pic.date = metadata["date"]
+
+def _tools(folder, key_path, url, dedupe_size):
+    # One of each per thread, since the log's sqlite connection can't be shared
+    from streetview import Session
+    from multipoint import Autoincrement
+    sesh = Session(folder, key_path, dedupe_size=dedupe_size, base_url=url)
+    return sesh, Autoincrement(key_path, debug=False, base_url=url, tracker=sesh.tracker)
+
+def _capture_stop(tools, stop, num_points, save):
+    """ Captures one stop start to finish, returning how long it took and how many errors it picked up. """
+    from streetview import POI
+    sesh, auto = tools
+    poi = POI(*stop)
+    start = time.perf_counter()
+    try:
+        sesh.improve_coords(poi)
+        auto.determine_points(poi, num_points)
+        sesh.capture_POI(poi, save=save)
+    except Exception as e:
+        # Failed requests can still blow up further down the line
+        poi.errors.append(e)
+    return time.perf_counter() - start, len(poi.errors)
+
+def capture(num_stops=50, modes=("sequential", "cached", "concurrent", "pipelined"), latency=.05, jitter=0., error_rate=0.,
+            workers=8, num_points=(1, 1), spacing=40, save=True):
+    """
+    Captures synthetic stops against a mock Maps server in each mode, returning a dict of stats for each.
+    Modes:
+        sequential: One stop at a time, without reusing images.
+        cached: One stop at a time, reusing images of panos that were just pulled.
+        concurrent: Stops split between a pool of threads, each with its own session.
+        pipelined: One session, with resolving, planning and pulling images each in their own pool of threads 
+            (see Session.capture_pipelined()). Split workers between them.
+    Args:
+        latency, jitter, error_rate: Passed to MockMaps.
+        num_points: Vantage points before and after the main one, passed to Autoincrement.
+        spacing: Meters between stops. Stops closer together than the mock's places snap onto the same place.
+        save: Whether to write images to disk.
+    """
+    stops = synthetic_stops(num_stops, spacing=spacing)
+    stats = {}
+    with MockMaps(latency=latency, jitter=jitter, error_rate=error_rate) as maps, \
+            tempfile.TemporaryDirectory() as folder, fake_osm():
+        key_path = os.path.join(folder, "key.txt")
+        with open(key_path, "w") as f:
+            f.write("mock")
+
+        for mode in modes:
+            maps.reset()
+            mode_folder = os.path.join(folder, mode)
+            start = time.perf_counter()
+
+            if mode == "concurrent":
+                # Give each thread its own tools and folder
+                local = threading.local()
+                count = iter(range(workers))
+                def work(stop):
+                    if not hasattr(local, "tools"):
+                        local.tools = _tools(os.path.join(mode_folder, str(next(count))), key_path, maps.url, 256)
+                    return _capture_stop(local.tools, stop, num_points, save)
+                with ThreadPoolExecutor(workers) as pool:
+                    results = list(pool.map(work, stops))
+            elif mode == "pipelined":
+                # Planning makes the most requests, so it gets the most threads
+                from streetview import POI
+                sesh, auto = _tools(mode_folder, key_path, maps.url, 256)
+                stages = (max(1, workers // 4), max(1, workers // 2), max(1, workers // 4))
+                results = [(time.perf_counter() - begin, len(poi.errors)) for poi, _, begin in 
+                           sesh.capture_pipelined((POI(*stop) for stop in stops), auto, num_points, save=save, workers=stages)]
+            else:
+                tools = _tools(mode_folder, key_path, maps.url, 256 if mode == "cached" else 0)
+                results = [_capture_stop(tools, stop, num_points, save) for stop in stops]
+
+            elapsed = time.perf_counter() - start
+            latencies = np.array([result[0] for result in results]) * 1000
+            stats[mode] = {
+                "stops_per_s": num_stops / elapsed,
+                "p50_ms": float(np.percentile(latencies, 50)),
+                "p99_ms": float(np.percentile(latencies, 99)),
+                "calls_per_stop": sum(maps.calls.values()) / num_stops,
+                **{f"{endpoint}_per_stop": count / num_stops for endpoint, count in maps.calls.items()},
+                "errors": sum(result[1] for result in results),
+            }
+    return stats
+
+def _measure(fn, make_inputs, trace):
+    """ 
+    Calls fn on each input, returning the time per call in seconds and, if tracing, the peak bytes each allocated. 
+    make_inputs gets called for a new list of argument tuples before each pass. 
+    """
+    times, allocs = [], []
+    for args in make_inputs():
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+
+    # Allocations get their own pass since tracemalloc slows everything down
+    if trace:
+        inputs = make_inputs()
+        tracemalloc.start()
+        for args in inputs:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            fn(*args)
+            allocs.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+    return np.array(times), np.array(allocs)
+
+def geometry(num_stops=200, kinds=ROAD_KINDS, num_points=(1, 1), interval=15, trace=True, profile=False):
+    """
+    Times multipoint's geometry functions per stop on each kind of synthetic road, with OSM and metadata stubbed out.
+    Returns a dict of stats for each (kind, function): mean and p99 ms per stop, plus the peak KB allocated per stop if tracing.
+    Args:
+        num_points, interval: Passed along to the functions, like a capture would.
+        trace: Whether to measure allocations with tracemalloc.
+        profile: Whether to print the top of a cProfile of determine_points() for each kind of road.
+    """
+    import geopandas as gpd
+    import multipoint
+    from shapely.geometry import Point
+    from streetview import POI
+
+    stops = synthetic_stops(num_stops, spacing=500)
+    stats = {}
+    with tempfile.TemporaryDirectory() as folder:
+        key_path = os.path.join(folder, "key.txt")
+        with open(key_path, "w") as f:
+            f.write("mock")
+        auto = multipoint.Autoincrement(key_path, debug=False)
+        auto.requests = FakeMetadata()
+
+        for kind in kinds:
+            with fake_osm(kind):
+                # Everything each function needs, built ahead of time so it isn't counted
+                pois = [POI(*stop) for stop in stops]
+                pts = [gpd.GeoDataFrame(geometry=[Point(poi.coords.lon, poi.coords.lat)], crs="EPSG:4326") 
+                       for poi in pois]
+                roads = [multipoint._get_road(poi, pt) for poi, pt in zip(pois, pts)]
+                points = [multipoint._generate_points(road, interval, pt, num_points).to_crs("EPSG:4326") 
+                          for road, pt in zip(roads, pts)]
+
+                # POIs collect pics as they go, so get_points() and determine_points() need fresh ones
+                fresh = lambda: [(POI(*stop),) for stop in stops]
+                functions = {
+                    "_get_road": (multipoint._get_road, lambda: list(zip(pois, pts))),
+                    "_generate_points": (multipoint._generate_points, 
+                                         lambda: [(road, interval, pt, num_points) for road, pt in zip(roads, pts)]),
+                    "_calc_headings": (multipoint._calc_headings, lambda: list(zip(points, pts))),
+                    "get_points": (lambda poi: multipoint.get_points(poi, num_points, interval), fresh),
+                    "determine_points": (lambda poi: auto.determine_points(poi, num_points), fresh),
+                }
+
+                for name, (fn, make_inputs) in functions.items():
+                    times, allocs = _measure(fn, make_inputs, trace)
+                    stats[(kind, name)] = {
+                        "mean_ms": float(times.mean() * 1000),
+                        "p99_ms": float(np.percentile(times, 99) * 1000),
+                        **({"peak_kb": float(allocs.mean() / 1024)} if trace else {}),
+                    }
+
+                if profile:
+                    print(f"--- determine_points on {kind} roads ---")
+                    profiler = cProfile.Profile()
+                    profiler.enable()
+                    for (poi,) in fresh():
+                        auto.determine_points(poi, num_points)
+                    profiler.disable()
+                    pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+    return stats
+
+def imports(paths=IMPORT_PATHS, runs=3):
+    """
+    Times how long each startup path takes to import, each run in a fresh interpreter with -X importtime.
+    Returns a dict of stats for each: the best wall time of the runs in seconds, and the five slowest top level 
+    imports as (module, cumulative seconds). Paths that fail to import get an "error" instead.
+    """
+    stats = {}
+    for name, code in paths.items():
+        walls = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], 
+                                    capture_output=True, text=True, cwd=HERE)
+            walls.append(time.perf_counter() - start)
+        if result.returncode:
+            stats[name] = {"error": result.stderr.strip().splitlines()[-1]}
+            continue
+
+        # Lines look like "import time: self [us] | cumulative | module", indented by how deep the import was
+        modules = []
+        for line in result.stderr.splitlines():
+            parts = line.split("|")
+            if len(parts) == 3 and parts[1].strip().isdigit() and not parts[2][1:].startswith(" "):
+                modules.append((parts[2].strip(), int(parts[1]) / 1e6))
+        stats[name] = {"wall_s": min(walls), "slowest": sorted(modules, key=lambda m: -m[1])[:5]}
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    capture_args = commands.add_parser("capture", help="End to end capturing against the mock Maps server.")
+    capture_args.add_argument("--stops", type=int, default=50)
+    capture_args.add_argument("--modes", nargs="+", default=["sequential", "cached", "concurrent", "pipelined"])
+    capture_args.add_argument("--latency", type=float, default=.05, help="Seconds per mock request.")
+    capture_args.add_argument("--jitter", type=float, default=0.)
+    capture_args.add_argument("--error-rate", type=float, default=0.)
+    capture_args.add_argument("--workers", type=int, default=8)
+    capture_args.add_argument("--no-save", action="store_true", help="Don't write images to disk.")
+
+    geometry_args = commands.add_parser("geometry", help="Multipoint's geometry, per stop, without any requests.")
+    geometry_args.add_argument("--stops", type=int, default=200)
+    geometry_args.add_argument("--kinds", nargs="+", default=list(ROAD_KINDS))
+    geometry_args.add_argument("--no-trace", action="store_true", help="Skip measuring allocations.")
+    geometry_args.add_argument("--profile", action="store_true", help="Print a cProfile of determine_points().")
+
+    import_args = commands.add_parser("imports", help="How long each way of running things takes to start up.")
+    import_args.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == "capture":
+        stats = capture(args.stops, args.modes, args.latency, args.jitter, args.error_rate, args.workers,
+                        save=not args.no_save)
+        for mode, row in stats.items():
+            print(f"{mode:>12}: {row['stops_per_s']:.1f} stops/s  p50: {row['p50_ms']:.0f}ms  "
+                  f"p99: {row['p99_ms']:.0f}ms  calls/stop: {row['calls_per_stop']:.1f} "
+                  f"(streetview {row.get('streetview_per_stop', 0):.1f}, metadata {row.get('metadata_per_stop', 0):.1f}, "
+                  f"nearbysearch {row.get('nearbysearch_per_stop', 0):.1f})  errors: {row['errors']}")
+
+    elif args.command == "geometry":
+        stats = geometry(args.stops, args.kinds, trace=not args.no_trace, profile=args.profile)
+        for (kind, name), row in stats.items():
+            alloc = f"  peak: {row['peak_kb']:.0f}KB" if "peak_kb" in row else ""
+            print(f"{kind:>9} {name:>17}: {row['mean_ms']:.2f}ms/stop  p99: {row['p99_ms']:.2f}ms{alloc}")
+
+    elif args.command == "imports":
+        for name, row in imports(runs=args.runs).items():
+            if "error" in row:
+                print(f"{name:>8}: failed ({row['error']})")
+                continue
+            slowest = ", ".join(f"{module} {seconds * 1000:.0f}ms" for module, seconds in row["slowest"])
+            print(f"{name:>8}: {row['wall_s'] * 1000:.0f}ms  slowest: {slowest}")
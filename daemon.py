@@ -0,0 +1,297 @@
+"""
+Keeps the model loaded in a long-lived process so that assessing doesn't have to pay for loading and warming it up
+every time. Jobs come in over a local socket:
+    - {"folder": path}: assess() a folder from a capture session, IE one with a log.json. 
+      Any of ASSESS_ARGS can be passed along to assess() as extra keys.
+    - {"log": path}: Same as above, for the folder the log.json is in.
+    - {"images": [JPEG bytes, ...], "keys": [(POI ID, pic number), ...]}: Scores images that are already in memory.
+Images from jobs that come in at the same time get run through the model together.
+Each run of the daemon makes a new random key that clients need to connect, saved where only this user can read it.
+
+Usage:
+    python daemon.py --port 6006
+Then from anywhere else:
+    with Client() as client:
+        client.assess("pics/atl")
+"""
+from multiprocessing.connection import Listener, Client as Connect
+from multiprocessing import AuthenticationError
+from concurrent.futures import Future
+from collections import defaultdict, deque
+from io import BytesIO
+import threading
+import secrets
+import queue
+import time
+import os
+
+# Where the daemon listens by default
+ADDRESS = ("localhost", 6006)
+
+# Keys jobs are allowed to pass along to assess()
+ASSESS_ARGS = {"output_folder", "min_conf", "chunk_size", "floor", "incremental", "output_every", "batch_size", 
+               "tensor_cache"}
+
+def key_path(port):
+    """ Where the daemon listening on a port keeps its key. """
+    return os.path.join(os.path.expanduser("~"), ".bus-stop-assess", f"daemon-{port}.key")
+
+def _write_key(path):
+    # Make a fresh key, readable only by this user
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    key = secrets.token_bytes(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+class MicroBatcher:
+    """
+    Stands in for a loaded YOLO model, so any number of threads can call it like one while a single thread runs it.
+    Images from calls that come in around the same time get run together in batches.
+    Args:
+        model: The ultralytics model.
+        max_batch: Most images to run at once.
+        max_wait: Longest a batch waits to fill up, in seconds.
+    """
+    def __init__(self, model, max_batch=16, max_wait=.005):
+        self.model = model
+        self.names = model.names
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def __call__(self, sources, conf=.25, **kwargs):
+        """ Runs the model on a list of images, same as calling the ultralytics model. Blocks until they're all done. """
+        futures = []
+        for source in sources:
+            future = Future()
+            self.queue.put((source, conf, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def _work(self):
+        # Images that came in with a different conf than the batch being built, saved for a later batch
+        deferred = deque()
+        while True:
+            first = deferred.popleft() if deferred else self.queue.get()
+            batch, later = [first], deque()
+            while deferred and len(batch) < self.max_batch:
+                item = deferred.popleft()
+                (batch if item[1] == first[1] else later).append(item)
+            deferred.extendleft(reversed(later))
+
+            # Wait a little for more images to show up
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.queue.get(timeout=max(0., deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                (batch if item[1] == first[1] else deferred).append(item)
+
+            # Run them all at once, handing each caller its own result
+            try:
+                outputs = self.model([item[0] for item in batch], conf=first[1], verbose=False)
+                for item, output in zip(batch, outputs):
+                    item[2].set_result(output)
+            except Exception as e:
+                for item in batch:
+                    item[2].set_exception(e)
+
+class Daemon:
+    """
+    Loads the model once, then serves jobs until told to stop.
+    Args:
+        address: Where to listen, passed to multiprocessing's Listener.
+        authkey: Key clients need to connect. Leave as None to make a random one and save it to key_file.
+        key_file: Where to save the key. Defaults to key_path() of the port.
+        model_path: Path to the model's weights.
+        max_batch, max_wait: See MicroBatcher.
+        floor: Lowest confidence kept when scoring in-memory images.
+    """
+    def __init__(self, address=ADDRESS, authkey=None, model_path="models/best.pt", max_batch=16, max_wait=.005,
+                 floor=.05, key_file=None):
+        from models import BusStopAssess
+        from assess import _hash_file
+        from PIL import Image
+
+        # Load and warm up the model, then put the batcher in front of it so every job shares it
+        self.model_path = model_path
+        self.model = BusStopAssess(None, model_path=model_path)
+        blank = Image.new("RGB", (640, 640))
+        for _ in range(2):
+            self.model.model(blank, verbose=False)
+        self.model.model = MicroBatcher(self.model.model, max_batch, max_wait)
+        self.model_hash = _hash_file(model_path)
+
+        self.address = address
+        self.key_file = None
+        if authkey is None:
+            self.key_file = key_file or key_path(address[1])
+            authkey = _write_key(self.key_file)
+        self.authkey = authkey
+        self.floor = floor
+        self.running = False
+
+        # Two jobs on the same folder would trip over each other's files
+        self._folder_locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def serve(self):
+        """ Accepts connections until a stop job comes in. Each connection gets its own thread. """
+        self.running = True
+        try:
+            with Listener(self.address, authkey=self.authkey) as listener:
+                print(f"[DAEMON] Listening on {listener.address}")
+                while self.running:
+                    try:
+                        conn = listener.accept()
+                    except (OSError, EOFError, AuthenticationError):
+                        # Someone hung up partway through, or didn't have the key
+                        continue
+                    threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            # The key's no good once the daemon's gone
+            if self.key_file and os.path.exists(self.key_file):
+                os.remove(self.key_file)
+
+    def _handle(self, conn):
+        # Answer each job on this connection in order until the other end hangs up
+        with conn:
+            while True:
+                try:
+                    job = conn.recv()
+                except (EOFError, OSError):
+                    return
+                start = time.perf_counter()
+                try:
+                    reply = {"ok": True, "result": self.run(job)}
+                except Exception as e:
+                    reply = {"ok": False, "error": repr(e)}
+                reply["seconds"] = time.perf_counter() - start
+                conn.send(reply)
+
+                if job.get("stop"):
+                    self._stop()
+                    return
+
+    def run(self, job: dict):
+        """ Runs one job, returning its result. See the top of this file for what jobs look like. """
+        job = dict(job)
+        if job.pop("stop", False):
+            return None
+        if "images" in job:
+            images, keys = job.pop("images"), job.pop("keys")
+            _check_args(job, {"min_conf"})
+            return self.score_images(images, keys, **job)
+        if "log" in job:
+            job["folder"] = os.path.dirname(os.path.abspath(job.pop("log")))
+        if "folder" in job:
+            folder = job.pop("folder")
+            _check_args(job, ASSESS_ARGS)
+            return self.assess(folder, **job)
+        raise ValueError(f"Don't know what to do with a job with {list(job)}")
+
+    def assess(self, folder, output_folder=None, **kwargs):
+        """ Runs assess() on a folder with the resident model. Returns the scores it wrote. """
+        import assess
+        import json
+        with self._lock:
+            folder_lock = self._folder_locks[os.path.abspath(folder)]
+        kwargs.setdefault("batch_size", 0)
+        with folder_lock:
+            # Each job gets its own image writer, so shut it down once the job's done
+            model = self.model.for_folder(folder, output_folder)
+            try:
+                assess.assess(folder, output_folder, model_path=self.model_path, model=model, 
+                              model_hash=self.model_hash, **kwargs)
+            finally:
+                model.close()
+            with open(os.path.join(output_folder or folder, "scores.json")) as f:
+                return json.load(f)
+
+    def score_images(self, images, keys, min_conf=.4):
+        """
+        Scores images that are already in memory.
+        Args:
+            images: JPEG (or PNG) bytes, PIL images or arrays.
+            keys: A (POI ID, pic number) pair for each image.
+        Returns a dict of each POI's scores by label.
+        """
+        from PIL import Image
+        images = [Image.open(BytesIO(image)) if isinstance(image, bytes) else image for image in images]
+        detections = self.model.for_folder(None).infer_images(images, keys, min(self.floor, min_conf))
+
+        # Sort scores into a dict of labels for each POI
+        scores = {str(poi_id): {} for poi_id, _ in keys}
+        for poi, label, score in zip(*(column.tolist() for column in detections.score(min_conf))):
+            scores[detections.poi_ids[poi]][detections.labels[label]] = score
+        return scores
+
+    def _stop(self):
+        # Poke the listener so it notices
+        self.running = False
+        try:
+            Connect(self.address, authkey=self.authkey).close()
+        except OSError:
+            pass
+
+def _check_args(job, allowed):
+    # Only pass along what the job is supposed to be able to change
+    unknown = set(job) - allowed
+    if unknown:
+        raise ValueError(f"Jobs can't set {sorted(unknown)}")
+
+class Client:
+    """
+    Sends jobs to a running daemon. Calls block until the job's done.
+    Raises a RuntimeError if the job failed.
+    Args:
+        authkey: The daemon's key. Read from key_file (by default, key_path() of the port) if not provided.
+    """
+    def __init__(self, address=ADDRESS, authkey=None, key_file=None):
+        if authkey is None:
+            with open(key_file or key_path(address[1]), "rb") as f:
+                authkey = f.read()
+        self.conn = Connect(address, authkey=authkey)
+
+    def request(self, job: dict):
+        """ Sends a job, returning the whole reply (IE with how long it took). """
+        self.conn.send(job)
+        reply = self.conn.recv()
+        if not reply["ok"]:
+            raise RuntimeError(f"Daemon failed: {reply['error']}")
+        return reply
+
+    def assess(self, folder, **kwargs):
+        return self.request({"folder": folder, **kwargs})["result"]
+
+    def score_images(self, images, keys, min_conf=.4):
+        return self.request({"images": images, "keys": keys, "min_conf": min_conf})["result"]
+
+    def stop(self):
+        """ Shuts the daemon down. """
+        self.request({"stop": True})
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Keeps the model loaded and serves assess jobs.")
+    parser.add_argument("--port", type=int, default=ADDRESS[1])
+    parser.add_argument("--model", default="models/best.pt", help="Path to the model's weights.")
+    parser.add_argument("--max-batch", type=int, default=16, help="Most images to run through the model at once.")
+    parser.add_argument("--max-wait", type=float, default=.005, help="Longest a batch waits to fill up, in seconds.")
+    args = parser.parse_args()
+
+    Daemon(("localhost", args.port), None, args.model, args.max_batch, args.max_wait).serve()
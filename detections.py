@@ -0,0 +1,160 @@
+"""
+Flat, columnar storage for the boxes found by the model, plus vectorized scoring
+"""
+import numpy as np
+import json
+
+# Columns of the table and their types
+COLUMNS = {
+    "poi": np.int32,
+    "pic": np.int16,
+    "label": np.int16,
+    "conf": np.float32,
+    "box": np.float32,
+}
+
+def exp_score(num_pics, mean_conf):
+    """ Default scoring function. Finding a label in multiple pics gives a big % boost. """
+    return (1 - np.exp(-num_pics)) * mean_conf
+
+class Detections:
+    """
+    A table of every box the model found, with one row per box. Each column is a numpy array.
+    Attributes:
+        poi_ids: IDs of the POIs. The poi column holds indexes into this list.
+        labels: Label names, keyed by the label column's IDs.
+        poi: Index of each box's POI in poi_ids.
+        pic: Pic number of the image each box was found in.
+        label: Label ID of each box.
+        conf: Confidence of each box.
+        box: Corners of each box (x1, y1, x2, y2) in pixels, as an (n, 4) array.
+        floor: Lowest confidence the model kept boxes at, so nothing can be scored below it. None if it isn't known.
+    """
+    def __init__(self, poi_ids=(), labels=None):
+        self.poi_ids = []
+        self.labels = labels
+        self.floor = None
+        self._index = {}
+        for poi_id in poi_ids:
+            self.poi_index(poi_id)
+
+        # Rows get added in parts, then concatenated the first time a column is read
+        self._parts = []
+        self._columns = {name: np.empty((0, 4) if name == "box" else 0, dtype)
+                         for name, dtype in COLUMNS.items()}
+
+    def poi_index(self, poi_id):
+        """ Gets the index of a POI, adding it to poi_ids if it's new. """
+        poi_id = str(poi_id)
+        if poi_id not in self._index:
+            self._index[poi_id] = len(self.poi_ids)
+            self.poi_ids.append(poi_id)
+        return self._index[poi_id]
+
+    def add(self, poi, pic, label, conf, box):
+        """ Adds the boxes found in one image. poi and pic are scalars, the rest are arrays with a row per box. """
+        n = len(conf)
+        if not n:
+            return
+        self._parts.append({
+            "poi": np.full(n, poi, COLUMNS["poi"]),
+            "pic": np.full(n, pic, COLUMNS["pic"]),
+            "label": np.asarray(label, COLUMNS["label"]),
+            "conf": np.asarray(conf, COLUMNS["conf"]),
+            "box": np.asarray(box, COLUMNS["box"]).reshape(n, 4),
+        })
+
+    def column(self, name):
+        # Merge any new parts in before handing the column over
+        if self._parts:
+            parts = [self._columns] + self._parts
+            self._columns = {col: np.concatenate([part[col] for part in parts]) for col in COLUMNS}
+            self._parts = []
+        return self._columns[name]
+
+    poi = property(lambda self: self.column("poi"))
+    pic = property(lambda self: self.column("pic"))
+    label = property(lambda self: self.column("label"))
+    conf = property(lambda self: self.column("conf"))
+    box = property(lambda self: self.column("box"))
+
+    def __len__(self):
+        return len(self.conf)
+
+    def select(self, mask):
+        """ Returns a new table with just the rows where mask is True. """
+        selected = Detections(self.poi_ids, self.labels)
+        selected._columns = {col: self.column(col)[mask] for col in COLUMNS}
+        return selected
+
+    def extend(self, other):
+        """ Adds all of the rows from another table, matching up their POIs with this one's. 
+            POIs without any rows in the other table aren't added. """
+        if self.labels is None:
+            self.labels = other.labels
+        if not len(other):
+            return
+
+        # Map the other table's POI indexes onto this one's 
+        part = {col: other.column(col) for col in COLUMNS}
+        remap = np.zeros(len(other.poi_ids), COLUMNS["poi"])
+        for i in np.unique(part["poi"]).tolist():
+            remap[i] = self.poi_index(other.poi_ids[i])
+        part["poi"] = remap[part["poi"]]
+        self._parts.append(part)
+
+    def save(self, path, floor=None):
+        """ Writes the table to a .npz file, along with the floor the boxes were kept at (if not this table's). """
+        labels = {str(id): name for id, name in self.labels.items()} if self.labels else {}
+        floor = self.floor if floor is None else floor
+        np.savez(path, poi_ids=np.array(self.poi_ids, dtype=str), labels=np.array(json.dumps(labels)),
+                 floor=np.array(np.nan if floor is None else floor), **{col: self.column(col) for col in COLUMNS})
+
+    @classmethod
+    def load(cls, path):
+        """ Reads a table written by save(). """
+        with np.load(path) as f:
+            labels = {int(id): name for id, name in json.loads(str(f["labels"])).items()}
+            detections = cls(f["poi_ids"].tolist(), labels)
+            detections._columns = {col: f[col] for col in COLUMNS}
+            # Tables saved before the floor was kept don't have one
+            if "floor" in f.files and not np.isnan(f["floor"]):
+                detections.floor = float(f["floor"])
+        return detections
+
+    def score(self, min_conf=0., score_fn=exp_score):
+        """
+        Scores each label of each POI. By default that's (1 - e^-n) * mean(max conf), where n is the number of pics
+        the label was found in and max conf is the highest confidence for the label in each of those pics.
+        Returns three arrays: the POI index, label ID and score of every (POI, label) pair that was found.
+        Args:
+            min_conf: Boxes under this confidence are ignored.
+            score_fn: Takes arrays of n and mean(max conf) for each (POI, label) pair, returns an array of scores.
+        """
+        # Drop anything under the threshold
+        keep = self.conf >= min_conf
+        poi, pic, label, conf = self.poi[keep], self.pic[keep], self.label[keep], self.conf[keep]
+        if not len(conf):
+            return poi.astype(np.int64), label.astype(np.int64), conf.astype(np.float64)
+
+        # Pack POI, label and pic into one key so a single sort groups every (POI, label, pic) together
+        num_labels = int(label.max()) + 1
+        pic_span = int(pic.max()) + 1
+        key = (poi.astype(np.int64) * num_labels + label) * pic_span + pic
+        order = np.argsort(key)
+        key, conf = key[order], conf[order].astype(np.float64)
+
+        # Find the highest conf for each pic 
+        starts = np.flatnonzero(np.diff(key, prepend=-1))
+        conf = np.maximum.reduceat(conf, starts)
+        key = key[starts] // pic_span
+
+        # Now count the pics each (POI, label) was found in and sum their max confs
+        starts = np.flatnonzero(np.diff(key, prepend=-1))
+        num_pics = np.diff(np.append(starts, len(key)))
+        conf_sum = np.add.reduceat(conf, starts)
+        key = key[starts]
+
+        # Total score is some function of the mean max conf and # pic occurences
+        scores = score_fn(num_pics, conf_sum / num_pics)
+        return key // num_labels, key % num_labels, scores
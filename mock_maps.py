@@ -0,0 +1,195 @@
+"""
+A local stand-in for the bits of the Google Maps API we use (streetview, streetview metadata and nearby search),
+so that Session, Requests and Autoincrement can be tested and benchmarked without spending any quota.
+Point them at it with base_url:
+
+    with MockMaps(latency=.05) as maps:
+        sesh = Session("pics", base_url=maps.url)
+
+Panos sit on a grid, so every location snaps to the pano at the middle of its cell.
+Places (IE bus stops) sit on a coarser grid, a little bit off from the panos.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from collections import Counter
+from io import BytesIO
+import threading
+import random
+import json
+import time
+import zlib
+
+# Paths of each endpoint, by the name they get counted under
+ENDPOINTS = {
+    "/maps/api/streetview": "streetview",
+    "/maps/api/streetview/metadata": "metadata",
+    "/maps/api/place/nearbysearch/json": "nearbysearch",
+}
+
+class MockMaps:
+    """
+    Serves fake Maps API responses from a background thread.
+    Args:
+        port: Port to listen on. 0 picks a free one.
+        latency: Seconds to wait before answering each request.
+        jitter: Up to this many extra seconds get added to the latency at random.
+        error_rate: Fraction of requests that fail with a 500.
+        pano_spacing: Distance between panos on the grid, in degrees (.0001 is about 11m).
+        place_spacing: Distance between places on the grid, in degrees.
+        date: Capture date given to every pano, unless it's in dates.
+        num_imgs: Number of different images to hand out. Each pano and heading always gets the same one.
+        seed: Seed for the latency jitter and errors.
+    Attributes:
+        url: Base URL to hand to Requests.
+        calls: Count of requests to each endpoint.
+        bytes_sent: Total size of the responses' bodies.
+        dates: Capture dates of specific panos, by pano ID. Change them to make it look like a pano's been updated.
+    """
+    def __init__(self, port=0, latency=0., jitter=0., error_rate=0., pano_spacing=.0001, place_spacing=.001,
+                 date="2023-05", num_imgs=16, seed=0):
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.pano_spacing = pano_spacing
+        self.place_spacing = place_spacing
+        self.date = date
+        self.dates = {}
+        self.num_imgs = num_imgs
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.bytes_sent = 0
+        self.url = None
+        self._imgs = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        """ Starts serving in a background thread, returns the base URL. """
+        self._server = ThreadingHTTPServer(("127.0.0.1", self.port), _make_handler(self))
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset(self):
+        """ Zeroes the call counts. """
+        with self._lock:
+            self.calls = Counter()
+            self.bytes_sent = 0
+
+    def snap(self, lat, lon, spacing):
+        """ Snaps a location to the grid, returning the cell's (row, col) and its center. """
+        row, col = round(lat / spacing), round(lon / spacing)
+        return (row, col), (row * spacing, col * spacing)
+
+    def metadata(self, params):
+        lat, lon = (float(x) for x in params["location"].split(","))
+        (row, col), (lat, lon) = self.snap(lat, lon, self.pano_spacing)
+        pano_id = f"mock_{row}_{col}"
+        return {"status": "OK", "pano_id": pano_id, "date": self.dates.get(pano_id, self.date),
+                "location": {"lat": lat, "lng": lon}, "copyright": "mock"}
+
+    def nearbysearch(self, params):
+        lat, lon = (float(x) for x in params["location"].split(","))
+        (row, col), (lat, lon) = self.snap(lat, lon, self.place_spacing)
+
+        # Nudge places off of the pano grid so they sit on the side of the road
+        offset = self.pano_spacing / 3
+        return {"status": "OK", "results": [{
+            "name": f"{params.get('keyword', 'place')} {row}_{col}".title(),
+            "place_id": f"place_{row}_{col}",
+            "geometry": {"location": {"lat": lat + offset, "lng": lon + offset}}}]}
+
+    def streetview(self, params):
+        # Same pano, date and heading always gets the same image
+        width, height = (int(x) for x in params.get("size", "640x640").split("x"))
+        pano = params.get("pano")
+        name = f"{pano or params.get('location')}|{self.dates.get(pano, self.date)}|{params.get('heading')}"
+        which = zlib.crc32(name.encode()) % self.num_imgs
+        key = (width, height, which)
+        if key not in self._imgs:
+            self._imgs[key] = _make_img(width, height, which)
+        return self._imgs[key]
+
+def _make_img(width, height, seed):
+    """ Makes a blocky JPEG that's different for each seed, so perceptual hashes can tell them apart. """
+    from PIL import Image
+    rng = random.Random(seed)
+    small = Image.frombytes("RGB", (16, 16), bytes(rng.randrange(256) for _ in range(16 * 16 * 3)))
+    buf = BytesIO()
+    small.resize((width, height)).save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+def _make_handler(maps: MockMaps):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            endpoint = ENDPOINTS.get(url.path.rstrip("/"))
+            params = {name: values[0] for name, values in parse_qs(url.query).items()}
+
+            # Wait, then maybe fail, like the real thing
+            with maps._lock:
+                delay = maps.latency + maps.random.random() * maps.jitter
+                failed = maps.random.random() < maps.error_rate
+                if endpoint:
+                    maps.calls[endpoint] += 1
+            if delay:
+                time.sleep(delay)
+
+            if endpoint is None:
+                self._send(404, b"unknown endpoint", "text/plain")
+            elif failed:
+                self._send(500, b"mock error", "text/plain")
+            elif endpoint == "streetview":
+                self._send(200, maps.streetview(params), "image/jpeg")
+            else:
+                body = json.dumps(getattr(maps, endpoint)(params)).encode()
+                self._send(200, body, "application/json")
+
+        def _send(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            with maps._lock:
+                maps.bytes_sent += len(body)
+
+        def log_message(self, format, *args):
+            # Way too noisy
+            pass
+
+    return Handler
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Serves a mock Google Maps API until stopped.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.)
+    parser.add_argument("--jitter", type=float, default=0.)
+    parser.add_argument("--error-rate", type=float, default=0.)
+    args = parser.parse_args()
+
+    with MockMaps(args.port, args.latency, args.jitter, args.error_rate) as maps:
+        print(f"Serving on {maps.url}. Ctrl+C to stop.")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
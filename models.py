@@ -1,21 +1,47 @@
-import cv2
 import numpy as np
-import ultralytics as ua
+import copy
 import os
-from collections import defaultdict
+import queue
+import shutil
+import threading
+from PIL import Image
+from detections import Detections
+from streetview import pic_key, dhash
 
 class BusStopAssess:
     """
     Various tools for running the project model.
     """
-    def __init__(self, input_path:str, output_path:str = None, model_path = "models/best.pt"):
-        # Set up model
+    def __init__(self, input_path:str, output_path:str = None, model_path = "models/best.pt", output_every=1, output_workers=2):
+        """
+        Args:
+            input_path: Folder containing the images (and log).
+            output_path: If you want annotated images to be saved, specify a path here. 
+            model_path: Path to the model's weights.
+            output_every: Only save every nth annotated image. 
+            output_workers: Number of background threads that render and save annotated images.
+        """
+        # Set up model. Ultralytics takes a while to import, so only do it once we actually need it
+        import ultralytics as ua
         self.model = ua.YOLO(model_path)
         self.labels = self.model.names
         self.num_labels = len(self.model.names)
         self.output_path = output_path
         self.input_path = input_path
+
+        # Annotated images get saved in the background so they don't slow down the model 
+        self.writer = ImageWriter(output_path, output_every, output_workers) if output_path else None
     
+    def for_folder(self, input_path:str, output_path:str = None, output_every=1, output_workers=2):
+        """ 
+        Makes a copy that reads images from (and saves them to) different folders, but shares this one's loaded model. 
+        """
+        other = copy.copy(self)
+        other.input_path = input_path
+        other.output_path = output_path
+        other.writer = ImageWriter(output_path, output_every, output_workers) if output_path else None
+        return other
+
     def infer(self, image_paths=None, output_folder="output"):
         """Runs the model with inputted images. Specify a folder path to infer every image in the folder."""
         # Ensure that input is provided
@@ -40,80 +66,197 @@ class BusStopAssess:
             # Save output image
             result.save(filename=f"{output_folder}/{name}")
 
-    def infer_log(self, stops, batch_infer=False, min_conf=.6,):
+    def infer_log(self, stops, batch_infer=False, min_conf=.6, dedupe=True, batch_size=0, cache=None, output_conf=None):
         """
         When supplied with the log from a streetview capture session, will return
         the classes with confidence scores for each bus stop. Images must be in same folder as log!
         Args:
-            input_folder: Folder containing BOTH the log and images.
+            stops: The log's stops (or some of them).
+            batch_infer: Run images through the model in batches instead of one at a time.
             min_conf: Minimum confidence score required to be part of results.
-            output_folder: If you want the outputted images to be saved, specify a path here. 
+            dedupe: Only run the model once for pics that resolve to the same image, IE the same pano and (roughly) heading 
+                and fov, or the same perceptual hash for pics pulled by location. Every one of them still gets the detections.
+            batch_size: Number of images per batch when batch_infer. 0 puts them all in one.
+            cache: A TensorCache of already letterboxed images. Pics that are in it get fed to the model straight from it 
+                instead of being decoded again. Boxes still come out in the original image's pixels. 
+                Ignored when saving annotated images, since those would come out letterboxed.
+            output_conf: Only draw boxes at or above this confidence on saved annotated images. 
+                Defaults to min_conf, IE when min_conf is a lower floor kept for rescoring.
         """
-        # It's faster to input all images at once but sometimes it doesn't work idk
-        if batch_infer:
-
-            # Get img paths in disgusting embedded loop
-            img_paths = []
-            for stop_id in stops:
-                stop = stops[stop_id]
-                for pic in stop['pictures']:
-                    img_paths.append(f"{self.input_path}/{stop_id}_{pic['pic_number']}.jpg")
-
-            # Run model on paths 
-            output = self.model(img_paths, conf=min_conf)
-
-        # Run imgs one at a time through model
-        else:
-            # Go through each stop 
-            output = []
-            for stop_id in stops:
-                stop = stops[stop_id]
-
-                # Go through each of this stop's images, running through model
-                for img_output in stop['pictures']:
-                    img_path = f"{self.input_path}/{stop_id}_{img_output['pic_number']}.jpg"
-                    output.append(self.model(img_path, conf=min_conf)[0])
-        
-        # Iterate through image output, scoring each POI's labels 
-        preds = {}
-        for img_output in output:
-            self.score_result(img_output, preds)
+        # Every stop with pictures gets a row index, even if nothing was found in it
+        preds = Detections([id for id in stops if stops[id]['pictures']], self.labels)
+
+        # Group pics that are the same image, keeping each one's (POI index, pic number). 
+        # Only the first pic of each group actually gets run 
+        groups = {}
+        for stop_id in stops:
+            stop = stops[stop_id]
+            for pic in stop['pictures']:
+                img_path = f"{self.input_path}/{stop_id}_{pic['pic_number']}.jpg"
+                group = self._dedupe_key(img_path, pic, stop.get('fov')) if dedupe else img_path
+                groups.setdefault(group, (img_path, []))[1].append((preds.poi_index(stop_id), pic['pic_number']))
+        sources = [source for source, _ in groups.values()]
+        keys = [keys for _, keys in groups.values()]
+
+        # Swap in views of the cached images where there are any, keeping how each was letterboxed
+        letterboxes = None
+        if cache is not None and not self.writer:
+            letterboxes = [None] * len(sources)
+            for i, img_keys in enumerate(keys):
+                poi, pic = img_keys[0]
+                hit = cache.get(preds.poi_ids[poi], pic)
+                if hit:
+                    sources[i], letterboxes[i] = hit
 
-        return preds
+        # It's faster to input all images at once but sometimes it doesn't work idk
+        batch_size = (batch_size or len(sources)) if batch_infer else 1
+        return self.infer_inputs(sources, keys, min_conf, preds, batch_size, letterboxes, output_conf)
 
-    def score_result(self, img_output, preds):
-        img_preds = defaultdict(list)
+    def _dedupe_key(self, img_path, pic, fov):
+        # Pics with a pano are the same image if they point the same way. Otherwise have to look at the image itself 
+        if pic.get('pano_id'):
+            return pic_key(pic['pano_id'], pic['heading'], fov)
+        with Image.open(img_path) as img:
+            return ("dhash", dhash(img))
 
-        # Iterate through boxes, getting classes and confidence levels
-        for box in img_output.boxes:
-            img_preds[self.labels[int(box.cls)]].append(float(box.conf))
+    def infer_images(self, images, keys, min_conf=.6, preds: Detections = None):
+        """
+        Runs the model on images that are already in memory, IE straight from a streetview Session. 
+        Args:
+            images: List of PIL images or arrays.
+            keys: A (POI ID, pic number) pair for each image.
+            min_conf: Minimum confidence score required to be part of results.
+            preds: Detections table to add to. A new one is made if not provided.
+        """
+        if preds is None:
+            preds = Detections(labels=self.labels)
 
-        # Save image if requested 
-        if self.output_path:
-            self.make_folder(self.output_path)
-            img_output.save(filename=img_output.path.replace(self.input_path, self.output_path))
-        
-        # Can't think of a less stupid way to get POI numbers
-        poi = img_output.path.split("/")[-1].split("_")[0]
-        
-        # See if this POI is in the dict
-        if poi not in preds:
-            preds[poi] = defaultdict(list)
+        # Run model on every image at once, adding to the table 
+        keys = [[(preds.poi_index(poi), pic)] for poi, pic in keys]
+        return self.infer_inputs(images, keys, min_conf, preds, len(images))
 
-        # Go through each label in the predictions 
-        for label in img_preds:
-            # Convert to Numpy array
-            label_confs = np.array(img_preds[label])
+    def infer_inputs(self, sources, keys, min_conf, preds: Detections, batch_size=1, letterboxes=None, 
+                     output_conf=None):
+        """
+        Runs the model on any mix of image paths, arrays and PIL images, adding what it finds to a Detections table.
+        Nothing here depends on where the images came from, since every image comes with its own keys.
+        Args:
+            sources: The images.
+            keys: For each image, a list of the (POI index, pic number) keys it belongs to. POI indexes come from preds.
+            min_conf: Minimum confidence score required to be part of results.
+            preds: Detections table to add to.
+            batch_size: Number of images to run through the model at a time.
+            letterboxes: For each image, the (x padding, y padding, scale) it was letterboxed with, IE if it came from 
+                a TensorCache, or None if it's the original. Used to put boxes back in the original image's pixels.
+            output_conf: See infer_log().
+        """
+        batch_size = max(1, batch_size)
+        if letterboxes is None:
+            letterboxes = [None] * len(sources)
+        for i in range(0, len(sources), batch_size):
+            output = self.model(sources[i:i + batch_size], conf=min_conf)
+            for img_output, img_keys, box in zip(output, keys[i:i + batch_size], letterboxes[i:i + batch_size]):
+                self.score_result(img_output, preds, img_keys, box, output_conf)
+        return preds
 
-            # See if this label has been added to the POI before
-            if label not in preds[poi]:
-                preds[poi][label] = [label_confs]
-            else: 
-                preds[poi][label].append(label_confs)
+    def score_result(self, img_output, preds: Detections, keys, letterbox=None, output_conf=None):
+        """ 
+        Adds the boxes found in an image to a Detections table under each of its (POI index, pic number) keys.
+        There's more than one key when several pics turned out to be the same image.
+        If the image was letterboxed (see infer_inputs), its boxes get moved back to the original image's pixels.
+        """
+        # Save image if requested (once for every key), without any boxes under output_conf
+        poi, pic = keys[0]
+        if self.writer:
+            shown = img_output[img_output.boxes.conf >= output_conf] if output_conf else img_output
+            self.writer.submit(shown, f"{preds.poi_ids[poi]}_{pic}.jpg", 
+                               [f"{preds.poi_ids[poi]}_{pic}.jpg" for poi, pic in keys[1:]])
+
+        # Pull classes, confidence levels and corners for every box at once
+        boxes = img_output.boxes
+        cls, conf, xyxy = boxes.cls.cpu().numpy(), boxes.conf.cpu().numpy(), boxes.xyxy.cpu().numpy()
+        if letterbox:
+            pad_x, pad_y, scale = letterbox
+            xyxy = (xyxy - np.array([pad_x, pad_y, pad_x, pad_y], xyxy.dtype)) / scale
+        for poi, pic in keys:
+            preds.add(poi, pic, cls, conf, xyxy)
+
+    def flush(self):
+        """ Waits for any annotated images that are still being saved. """
+        if self.writer:
+            self.writer.flush()
+
+    def close(self):
+        """ Finishes saving annotated images, then stops the threads saving them. """
+        if self.writer:
+            self.writer.close()
 
     def make_folder(self, path):
         if not os.path.exists(path): 
             os.makedirs(path)
+
+class ImageWriter:
+    """
+    Renders and saves the model's annotated images using a pool of background threads.
+    The queue is bounded, so if saving falls behind the model waits instead of piling up images in memory.
+    """
+    def __init__(self, folder:str, every=1, workers=2, queue_size=32):
+        """
+        Args:
+            folder: Where to save images.
+            every: Only save every nth image submitted. 
+            workers: Number of threads rendering and saving images.
+            queue_size: Max number of images waiting to be saved.
+        """
+        # Make the folder once up front 
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.every = max(1, every)
+        self.submitted = 0
+
+        # Start up workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, result, name:str, copies=()):
+        """ 
+        Queues up an ultralytics result to be saved as name. 
+        Args:
+            copies: Other names to save the same image as, IE pics that were deduped into this one. Only rendered once.
+        """
+        self.submitted += 1
+        if (self.submitted - 1) % self.every == 0:
+            self.queue.put((result, name, copies))
+
+    def flush(self):
+        """ Blocks until everything that's been submitted is saved. """
+        self.queue.join()
+
+    def close(self):
+        """ Saves everything that's been submitted, then shuts down the workers. """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            result, name, copies = item
+            try:
+                result.save(filename=os.path.join(self.folder, name))
+                for other in copies:
+                    shutil.copyfile(os.path.join(self.folder, name), os.path.join(self.folder, other))
+            except Exception as e:
+                print(f"[ERROR] Got {e} when saving {name}!")
+            finally:
+                self.queue.task_done()
             
 class BusStopCV:
     """
@@ -121,8 +264,6 @@ class BusStopCV:
     Didn't generalize well (failed to detect MARTA bus stops)
     https://makeabilitylab.cs.washington.edu/project/busstopcv/
     """
-    # import onnxruntime as ort
-
     # Constants
     input_shape = [1, 3, 640, 640]
     topk = 100
@@ -130,111 +271,123 @@ class BusStopCV:
     scoreThreshold = 0.2
     class_names = ["Seating", "Shelter", "Signage", "Trash Can"] 
 
-    def __init__(self):
-        # Set up models
-        self.model = self.ort.InferenceSession("models/attempt-2.onnx")
-        self.nms = self.ort.InferenceSession("models/nms-yolov8.onnx")
+    def __init__(self, model_path="models/attempt-2.onnx", nms_path="models/nms-yolov8.onnx", batch_size=8, threads=0):
+        """
+        Args:
+            batch_size: Max images per run of the model. Ignored if the model only takes one image at a time.
+            threads: Threads ORT uses within each op. 0 lets ORT decide. 
+        """
+        import onnxruntime as ort
 
-    def infer(self, image_path: str):
-        # Read image, store dimensions
-        image = cv2.imread(image_path)  
-        self.original_height, self.original_width = image.shape[:2]
+        # Tune sessions for CPU 
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+
+        # Set up models
+        self.model = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.nms = ort.InferenceSession(nms_path, options, providers=["CPUExecutionProvider"])
+        self.config = np.array([self.topk, self.iouThreshold, self.scoreThreshold], dtype=np.float32)
 
-        # Pre-process image
-        processed_image = self.preprocess_image(image)
+        # Some exports have a fixed batch dimension, stick to it if so
+        batch_dim = self.model.get_inputs()[0].shape[0]
+        self.batch_size = batch_dim if isinstance(batch_dim, int) else batch_size
 
-        # Run models
-        config = np.array([self.topk, self.iouThreshold, self.scoreThreshold])
-        output = self.model.run(None, {"images": processed_image})
-        selected = self.nms.run(None, {"detection": output[0], "config": config.astype(np.float32)})
+        # Buffers get reused between batches. Kept per thread so that one instance can be shared between threads
+        self._local = threading.local()
 
-        # Get and draw boxes on the original image size
-        boxes = self.get_boxes(selected[0])
+    def infer(self, image_path: str):
+        # Read image, run it, draw boxes on the original image size
+        import cv2
+        image = cv2.imread(image_path)  
+        boxes = self.infer_batch([image])[0]
         return self.draw_boxes(boxes, image)
+
+    def infer_batch(self, images):
+        """
+        Runs a list of images (BGR arrays, IE from cv2.imread) through the model. 
+        Returns a dict of boxes for each image, with arrays for "label", "prob" and "bounds" (x1, y1, x2, y2 in pixels).
+        """
+        results = []
+        for i in range(0, len(images), self.batch_size):
+            # Pre-process this batch into one tensor
+            batch = images[i:i + self.batch_size]
+            tensor, pads, scales = self.preprocess_images(batch)
+
+            # Run model on the whole batch, then NMS on each image since it only takes one
+            output = self.model.run(None, {"images": tensor})[0]
+            for j in range(len(batch)):
+                selected = self.nms.run(None, {"detection": output[j:j + 1], "config": self.config})[0]
+                results.append(self.get_boxes(selected, pads[j], scales[j]))
+        return results
     
-    def preprocess_image(self, image):
-        height, width = image.shape[:2]
-
-        # Calculate scaling factors to preserve the aspect ratio
-        if width > height:
-            scale = 640 / width
-            new_width = 640
-            new_height = int(height * scale)
-        else:
-            scale = 640 / height
-            new_height = 640
-            new_width = int(width * scale)
-
-        # Resize the image while preserving the aspect ratio
-        resized_image = cv2.resize(image, (new_width, new_height))
-
-        # Calculate padding to make the image 640x640
-        self.x_pad = (640 - new_width) // 2
-        self.y_pad = (640 - new_height) // 2
-
-        # Add padding
-        padded_image = cv2.copyMakeBorder(
-            src = resized_image, 
-            top = self.y_pad, 
-            bottom = 640 - new_height - self.y_pad, 
-            left = self.x_pad, 
-            right = 640 - new_width - self.x_pad, 
-            borderType = cv2.BORDER_CONSTANT, 
-            value = (114, 114, 114))
-
-        # Normalize, expand dimensions, transpose
-        padded_image = padded_image.astype(np.float32) / 255.0    
-        padded_image = np.expand_dims(padded_image, axis=0)       
-        padded_image = np.transpose(padded_image, (0, 3, 1, 2))  
-
-        # Return the preprocessed image and scaling factors for post-processing
-        self.scale_x = width / new_width
-        self.scale_y = height / new_height
-
-        return padded_image
+    def preprocess_images(self, images):
+        """ 
+        Letterboxes images into one normalized NCHW float32 tensor. 
+        Returns the tensor, plus the (x, y) padding and scale of each image for post-processing.
+        """
+        # Grab this thread's buffers, making them the first time
+        import cv2
+        if not hasattr(self._local, "tensor"):
+            self._local.tensor = np.empty((self.batch_size, 3, 640, 640), dtype=np.float32)
+            self._local.canvas = np.empty((640, 640, 3), dtype=np.uint8)
+        tensor, canvas = self._local.tensor, self._local.canvas
+
+        pads = np.empty((len(images), 2), dtype=np.float32)
+        scales = np.empty((len(images), 2), dtype=np.float32)
+        for i, image in enumerate(images):
+            height, width = image.shape[:2]
+
+            # Calculate scaling factors to preserve the aspect ratio
+            if width > height:
+                new_width = 640
+                new_height = int(height * 640 / width)
+            else:
+                new_height = 640
+                new_width = int(width * 640 / height)
+
+            # Resize the image into the middle of a gray canvas
+            x_pad = (640 - new_width) // 2
+            y_pad = (640 - new_height) // 2
+            canvas[:] = 114
+            canvas[y_pad:y_pad + new_height, x_pad:x_pad + new_width] = cv2.resize(image, (new_width, new_height))
+
+            # Normalize and transpose straight into the tensor 
+            np.multiply(canvas.transpose(2, 0, 1), np.float32(1 / 255), out=tensor[i])
+
+            # Store padding and scaling factors for post-processing
+            pads[i] = (x_pad, y_pad)
+            scales[i] = (width / new_width, height / new_height)
+
+        return tensor[:len(images)], pads, scales
     
-    def get_boxes(self, selected):
-        boxes = []
-        for i in range(selected.shape[1]):
-            # Get rows
-            data = selected[0, i, :]
-            x, y, w, h = data[:4]
-
-            # Get max score and corresponding label
-            scores = data[4:]
-            score = np.max(scores)
-            label = np.argmax(scores)
-
-            # Convert box coordinates 
-            x1, y1 = x - w / 2, y - h / 2
-            x2, y2 = x + w / 2, y + h / 2
-
-            # Remove the padding and scale the box coordinates back to the original image size
-            x1 = int((x1 - self.x_pad) * self.scale_x)
-            y1 = int((y1 - self.y_pad) * self.scale_y)
-            x2 = int((x2 - self.x_pad) * self.scale_x)
-            y2 = int((y2 - self.y_pad) * self.scale_y)
-
-            # Add to box list
-            boxes.append({
-                "label": label, 
-                "prob": score, 
-                "bounds": (x1, y1, x2, y2)
-            })
-        
-        return boxes
+    def get_boxes(self, selected, pad, scale):
+        # Rows are x, y, w, h followed by a score for each class
+        data = selected[0]
+        xy, wh, scores = data[:, :2], data[:, 2:4], data[:, 4:]
+
+        # Convert to corners, remove the padding and scale back to the original image size
+        corners = np.concatenate([xy - wh / 2, xy + wh / 2], axis=1)
+        corners = ((corners - np.tile(pad, 2)) * np.tile(scale, 2)).astype(int)
+
+        return {
+            "label": np.argmax(scores, axis=1),
+            "prob": np.max(scores, axis=1),
+            "bounds": corners
+        }
     
     def draw_boxes(self, boxes, image):
+        import cv2
         final = image
 
-        # Iterate through box list 
-        for box in boxes:
-            # Extract bounds and draw onto inputted image
-            bounds = box["bounds"]
+        # Iterate through boxes 
+        for label, prob, bounds in zip(boxes["label"], boxes["prob"], boxes["bounds"]):
+            # Draw bounds onto inputted image
             cv2.rectangle(final, (bounds[0], bounds[1]), (bounds[2], bounds[3]), (0, 255, 0), 2)
         
              # Display confidence and class label
-            label = f"{self.class_names[box['label']]}: {box['prob']:.2f}"
-            cv2.putText(final, label, (bounds[0], bounds[1] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+            text = f"{self.class_names[label]}: {prob:.2f}"
+            cv2.putText(final, text, (bounds[0], bounds[1] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
         return final
-
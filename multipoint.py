@@ -1,15 +1,32 @@
-import geopandas as gpd
-import osmnx as ox
-from shapely.geometry import Point
-from shapely.ops import linemerge, unary_union
-from pyproj import Transformer
-from streetview import POI, Pic, Coord
+from streetview import POI, Pic, Coord, POIBatch
 import math
+import threading
+from collections import OrderedDict
 from services import Error
 import numpy as np
 
+# The geo libraries take seconds to import, so they're only loaded by the functions that need them.
+# osmnx is kept as a global so that it can be swapped out, IE by benchmark.py's fake roads
+ox = None
+_local = threading.local()
+
+# Number of roads Autoincrement holds onto. Only needs to cover the POIs being captured at the same time
+ROAD_CACHE_SIZE = 64
+
+def _to_lonlat():
+    """ This thread's transformer from web mercator back to lon/lat. They're slow to make, so each thread makes one. """
+    if not hasattr(_local, "transformer"):
+        from pyproj import Transformer
+        _local.transformer = Transformer.from_crs("EPSG:3857", "EPSG:4326", always_xy=True)
+    return _local.transformer
+
 def _get_road(poi: POI, original_pt):
     """ Finds the road that the POI most likely sits on. Has to stitch multiple segments together. """
+    global ox
+    if ox is None:
+        import osmnx as ox
+    from shapely.ops import linemerge, unary_union
+
     # Make a bounding box around the point 
     point_buffer = original_pt.to_crs(epsg=26916).buffer(200).to_crs("EPSG:4326")
     bbox = point_buffer.total_bounds
@@ -48,6 +65,8 @@ def _get_road(poi: POI, original_pt):
     
 def _generate_points(road, interval, main_pt, num_pts):
     """ Generates points along a linestring (road). """
+    import geopandas as gpd
+
     # Project point for meter-based calculations 
     main_pt = main_pt.to_crs("EPSG:3857")
 
@@ -94,6 +113,8 @@ def get_points(poi: POI, num_points=(0,0), interval=15):
             interval: The distance between each point in meters.
     """
     # Make POI's coords into a geodataframe 
+    import geopandas as gpd
+    from shapely.geometry import Point
     original_pt = gpd.GeoDataFrame(geometry=[Point(poi.coords.lon, poi.coords.lat)], crs="EPSG:4326")
 
     # Find the road that this POI sits on
@@ -120,14 +141,24 @@ def get_points(poi: POI, num_points=(0,0), interval=15):
         poi.pics.append(pic)
 
 class Autoincrement:
-    from services import Requests, Misc
+    from services import Requests, Misc, Tracker
 
-    def __init__(self, key_path:str, debug=True):
+    def __init__(self, key_path:str, debug=True, base_url="https://maps.googleapis.com", tracker=None, retries=0):
+        # Share the session's tracker so that its log picks up our requests and timings too
+        self.tracker = tracker if tracker else self.Tracker(enabled=False)
         self.requests = self.Requests(key=open(key_path, "r").read(),
                                       pic_dims=None,
-                                      debug=debug)
+                                      debug=debug,
+                                      base_url=base_url,
+                                      retries=retries,
+                                      tracker=self.tracker)
         self.debug = debug
 
+        # Roads of the last few POIs, so that calling determine_points() again on one (IE adaptive capture going back 
+        # for more vantage points) doesn't hit OSM again. Keyed by the POI's ID and coords
+        self._roads = OrderedDict()
+        self._roads_lock = threading.Lock()
+
     def _check_redundancy(self, min_dist, add_dist, panos, rd, poi:POI):
             # Calculate distance that this point should be from the main one. 
             distance = min_dist + add_dist
@@ -139,7 +170,7 @@ class Autoincrement:
                 stop_trying = True
 
             # Interpolate the point onto the road and transform it
-            transformer = Transformer.from_crs("EPSG:3857", "EPSG:4326", always_xy=True)
+            transformer = _to_lonlat()
             new_pt = rd.interpolate(distance)
             lon, lat = transformer.transform(new_pt.x, new_pt.y)
 
@@ -173,15 +204,38 @@ class Autoincrement:
                 poi: The point of interest around which points will be located 
                 num_points: The number of points before and after the main point in the format of (before, after)
                 min_interval: The distance between each point in meters.
+            Can be called again on a POI that already has pics to add more vantage points around them.
         """
         # Make POI's coords into a geodataframe 
+        import geopandas as gpd
+        from shapely.geometry import Point
         main_pt = gpd.GeoDataFrame(geometry=[Point(poi.coords.lon, poi.coords.lat)], crs="EPSG:4326")
 
         # Find the road that this POI sits on
-        nearest_rd = _get_road(poi, main_pt)
-        
-        # If we can't find nearest road, just use POI's coords to build a pic
+        key = (poi.id, poi.coords.lat, poi.coords.lon)
+        with self._roads_lock:
+            cached = key in self._roads
+            nearest_rd = self._roads.get(key)
+        if not cached:
+            with self.tracker.stage("road_lookup", poi.id):
+                nearest_rd = _get_road(poi, main_pt)
+            with self._roads_lock:
+                self._roads[key] = nearest_rd
+                if len(self._roads) > ROAD_CACHE_SIZE:
+                    self._roads.popitem(last=False)
+
+        with self.tracker.stage("autoincrement", poi.id):
+            return self._increment(poi, main_pt, nearest_rd, num_points, min_interval, add_interval)
+
+    def determine_batch(self, batch: POIBatch, num_points=(0,0), min_interval=5, add_interval=1):
+        """ Runs determine_points() on every POI in a POIBatch, returning a new batch of them with their pics. """
+        return POIBatch.from_pois(self.determine_points(poi, num_points, min_interval, add_interval) for poi in batch)
+
+    def _increment(self, poi: POI, main_pt, nearest_rd, num_points, min_interval, add_interval):
+        # If we can't find nearest road, just use POI's coords to build a pic (unless it already has one)
         if nearest_rd is None: 
+            if poi.pics:
+                return poi
             pic = Pic(1, coords=poi.coords)
             self.requests.pull_pano_info(pic, poi)
             self.Misc.estimate_heading(pic, poi)
@@ -193,9 +247,11 @@ class Autoincrement:
         main_pt_projected =  nearest_rd.interpolate(nearest_rd.project(main_pt.geometry.iloc[0]))
         start_distance = nearest_rd.project(main_pt_projected)
 
-        # Add main point to the list of panos so that future points don't override it 
-        pano_ids = []
-        self._check_redundancy(start_distance, add_interval, pano_ids, nearest_rd, poi)
+        # Add main point to the list of panos so that future points don't override it. 
+        # If the POI already has pics (IE from an earlier call), keep them and don't reuse their panos
+        pano_ids = [pic.pano_id for pic in poi.pics]
+        if not pano_ids:
+            self._check_redundancy(start_distance, add_interval, pano_ids, nearest_rd, poi)
 
         # Iterate through the points we need to add
         for i in range(-num_points[0], num_points[1] + 1):
@@ -0,0 +1,296 @@
+"""
+Spatial index and queries over the scores from assess(), so that questions like "stops without a shelter within 400m
+of this route" don't mean loading and scanning all of scores.json. Also exports GeoJSON or vector tiles for maps.
+
+    results = Results.load("pics/atl")
+    no_shelter = results.route(route_coords, 400, scores={"Shelter": (None, .2)})
+    results.export_tiles("tiles", zooms=(12, 14))
+
+Score filters are a dict of {label: (min, max)}, where either bound can be None. Stops where a label wasn't found
+have a score of 0 for it.
+"""
+import numpy as np
+import json
+import math
+import os
+
+# Close enough for distances within a city
+METERS_PER_DEGREE = 111_320
+EARTH_RADIUS = 6_371_000
+
+# Grid cells are keyed by row * CELL_SPAN + column, so each row of cells is one contiguous run of keys
+CELL_SPAN = 1 << 32
+
+# Furthest from the equator web mercator goes
+MAX_MERCATOR_LAT = 85.0511
+
+class Results:
+    """
+    Assessed stops and their scores as columns, with a grid index over their coordinates for spatial queries.
+    Queries return a new Results with just the stops that matched.
+    Args:
+        ids: Stop IDs.
+        lat, lon: Each stop's coordinates.
+        labels: Names of the labels, one for each column of scores.
+        scores: (n, number of labels) array of each stop's score for each label.
+        names: Each stop's place name.
+        cell_size: Size of the grid's cells, in degrees. Smaller cells mean queries look at fewer stops
+            but have to check more cells. The default is about 550m.
+        distance: Distance in meters of each stop from whatever it was queried by. None if it wasn't.
+    """
+    def __init__(self, ids, lat, lon, labels, scores, names=None, cell_size=.005, distance=None):
+        self.ids = np.asarray(ids, dtype=str)
+        self.lat = np.asarray(lat, np.float64)
+        self.lon = np.asarray(lon, np.float64)
+        self.labels = list(labels)
+        self.scores = np.asarray(scores, np.float32).reshape(len(self.ids), len(self.labels))
+        self.names = np.asarray(names if names is not None else [""] * len(self.ids), dtype=str)
+        self.cell_size = cell_size
+        self.distance = distance
+
+        # Built the first time a spatial query needs it
+        self._cells = None
+
+    @classmethod
+    def from_scores(cls, scores:dict, cell_size=.005):
+        """ Builds the table from the scores dict assess() writes to scores.json. """
+        labels = sorted({label for stop in scores.values() for label in stop["amenity_scores"]})
+        columns = {label: i for i, label in enumerate(labels)}
+        table = np.zeros((len(scores), len(labels)), np.float32)
+        for row, stop in enumerate(scores.values()):
+            for label, score in stop["amenity_scores"].items():
+                table[row, columns[label]] = score
+
+        stops = scores.values()
+        return cls(list(scores), [stop["latitude"] for stop in stops], [stop["longitude"] for stop in stops], labels,
+                   table, [stop.get("gmaps_place_name") or "" for stop in stops], cell_size)
+
+    @classmethod
+    def load(cls, path:str, cell_size=.005):
+        """ Reads a scores.json, or the one in a folder. """
+        if os.path.isdir(path):
+            path = os.path.join(path, "scores.json")
+        with open(path) as f:
+            return cls.from_scores(json.load(f), cell_size)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def select(self, idx, distance=None):
+        """ Returns a new Results with just the given rows (indexes or a mask), in that order. """
+        if distance is None and self.distance is not None:
+            distance = self.distance[idx]
+        return Results(self.ids[idx], self.lat[idx], self.lon[idx], self.labels, self.scores[idx], self.names[idx],
+                       self.cell_size, distance)
+
+    def column(self, label):
+        """ Every stop's score for a label. All 0s if it was never found. """
+        if label not in self.labels:
+            return np.zeros(len(self), np.float32)
+        return self.scores[:, self.labels.index(label)]
+
+    def where(self, scores:dict):
+        """ Returns the stops whose scores are within the given {label: (min, max)} bounds. """
+        return self.select(np.flatnonzero(self._matches(np.arange(len(self)), scores)))
+
+    def _matches(self, idx, scores):
+        # Mask of which of the given rows pass every score filter
+        keep = np.ones(len(idx), bool)
+        for label, (low, high) in (scores or {}).items():
+            column = self.column(label)[idx]
+            if low is not None:
+                keep &= column >= low
+            if high is not None:
+                keep &= column <= high
+        return keep
+
+    def _index(self):
+        # Sort the stops by which cell they're in. Keep the range of rows so queries don't look past the data
+        if self._cells is None:
+            rows = np.floor(self.lat / self.cell_size).astype(np.int64)
+            cols = np.floor(self.lon / self.cell_size).astype(np.int64) + CELL_SPAN // 2
+            keys = rows * CELL_SPAN + cols
+            order = np.argsort(keys, kind="stable")
+            row_range = (int(rows.min()), int(rows.max())) if len(rows) else (0, -1)
+            self._cells = keys[order], order, row_range
+        return self._cells
+
+    def _candidates(self, south, west, north, east):
+        """ Indexes of every stop in a cell that overlaps a bounding box. Some will be outside of it. """
+        keys, order, (first_row, last_row) = self._index()
+        rows = np.arange(max(math.floor(south / self.cell_size), first_row),
+                         min(math.floor(north / self.cell_size), last_row) + 1, dtype=np.int64) * CELL_SPAN
+        west = math.floor(west / self.cell_size) + CELL_SPAN // 2
+        east = math.floor(east / self.cell_size) + CELL_SPAN // 2
+
+        if not len(rows):
+            return order[:0]
+
+        # Each row of cells is one slice of the sorted keys
+        starts = np.searchsorted(keys, rows + west)
+        ends = np.searchsorted(keys, rows + east, side="right")
+        return order[np.concatenate([np.arange(start, end) for start, end in zip(starts.tolist(), ends.tolist())])]
+
+    def bbox(self, south, west, north, east, scores:dict = None):
+        """ Returns the stops inside a bounding box (in degrees) that pass the score filters. """
+        idx = self._candidates(south, west, north, east)
+        lat, lon = self.lat[idx], self.lon[idx]
+        keep = (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east) & self._matches(idx, scores)
+        return self.select(np.sort(idx[keep]))
+
+    def radius(self, lat, lon, meters, scores:dict = None):
+        """ Returns the stops within some meters of a point that pass the score filters, closest first. """
+        south, west, north, east = _around(lat, lat, lon, lon, meters)
+        idx = self._candidates(south, west, north, east)
+        distance = haversine(lat, lon, self.lat[idx], self.lon[idx])
+        keep = (distance <= meters) & self._matches(idx, scores)
+        idx, distance = idx[keep], distance[keep]
+        order = np.argsort(distance, kind="stable")
+        return self.select(idx[order], distance[order])
+
+    def nearest(self, lat, lon, k=1, scores:dict = None):
+        """ Returns the k closest stops to a point that pass the score filters, closest first. """
+        # Keep doubling the radius until there's enough. Once its box covers every stop, the grid can't help anymore
+        meters = self.cell_size * METERS_PER_DEGREE
+        while len(self):
+            south, west, north, east = _around(lat, lat, lon, lon, meters)
+            if (south <= self.lat.min() and north >= self.lat.max() and
+                west <= self.lon.min() and east >= self.lon.max()):
+                break
+            found = self.radius(lat, lon, meters, scores)
+            if len(found) >= k:
+                return found.select(np.arange(k))
+            meters *= 2
+
+        # Check every stop, since the corners of the box can be further away than its radius
+        idx = np.flatnonzero(self._matches(np.arange(len(self)), scores))
+        distance = haversine(lat, lon, self.lat[idx], self.lon[idx])
+        if k < len(idx):
+            closest = np.argpartition(distance, k - 1)[:k]
+            idx, distance = idx[closest], distance[closest]
+        order = np.argsort(distance, kind="stable")
+        return self.select(idx[order], distance[order])
+
+    def route(self, coords, meters, scores:dict = None):
+        """
+        Returns the stops within some meters of a route that pass the score filters, closest first.
+        Args:
+            coords: (lat, lon) of each point along the route.
+        """
+        coords = np.asarray(coords, np.float64).reshape(-1, 2)
+        segments = list(zip(coords[:-1], coords[1:])) or [(coords[0], coords[0])]
+
+        # Flatten into meters around the route, which is plenty accurate at city scale
+        x_scale = METERS_PER_DEGREE * math.cos(math.radians(coords[:, 0].mean()))
+        def to_xy(lat, lon):
+            return np.stack([lon * x_scale, lat * METERS_PER_DEGREE], axis=-1)
+
+        # Only look near each segment, keeping every stop's distance to the closest one
+        best = np.full(len(self), np.inf)
+        for start, end in segments:
+            idx = self._candidates(*_around(min(start[0], end[0]), max(start[0], end[0]),
+                                            min(start[1], end[1]), max(start[1], end[1]), meters))
+            points = to_xy(self.lat[idx], self.lon[idx])
+            a, b = to_xy(*start), to_xy(*end)
+            ab = b - a
+            t = np.clip((points - a) @ ab / max(ab @ ab, 1e-12), 0, 1)
+            distance = np.linalg.norm(points - (a + t[:, None] * ab), axis=1)
+            best[idx] = np.minimum(best[idx], distance)
+
+        idx = np.flatnonzero(best <= meters)
+        idx = idx[self._matches(idx, scores)]
+        order = np.argsort(best[idx], kind="stable")
+        return self.select(idx[order], best[idx][order])
+
+    def properties(self, i):
+        """ A stop's ID, name and scores (plus distance, if it came from a query) as a flat dict. """
+        props = {"id": str(self.ids[i]), "place_name": str(self.names[i])}
+        props.update(zip(self.labels, self.scores[i].tolist()))
+        if self.distance is not None:
+            props["distance"] = float(self.distance[i])
+        return props
+
+    def to_geojson(self):
+        """ Returns the stops as a GeoJSON FeatureCollection dict. """
+        return {"type": "FeatureCollection", "features": [
+            {"type": "Feature", "geometry": {"type": "Point", "coordinates": [lon, lat]}, "properties": self.properties(i)}
+            for i, (lat, lon) in enumerate(zip(self.lat.tolist(), self.lon.tolist()))]}
+
+    def save_geojson(self, path:str):
+        with open(path, "w") as f:
+            json.dump(self.to_geojson(), f)
+
+    def tiles(self, zoom:int):
+        """ Splits the stops up by the web mercator (IE slippy map) tile they're in. Yields ((x, y), Results) for each tile. """
+        x, y = _mercator(self.lat, self.lon, zoom)
+        x, y = np.floor(x).astype(np.int64), np.floor(y).astype(np.int64)
+
+        # One sort groups every tile's stops together
+        key = x * (1 << zoom) + y
+        order = np.argsort(key, kind="stable")
+        starts = np.flatnonzero(np.diff(key[order], prepend=-1))
+        for rows in np.split(order, starts[1:]):
+            if len(rows):
+                yield (int(x[rows[0]]), int(y[rows[0]])), self.select(rows)
+
+    def export_tiles(self, folder:str, zooms=(14,), format="geojson", layer="stops", extent=4096):
+        """
+        Writes a tile for every tile with stops in it, to folder/zoom/x/y.geojson (or .mvt).
+        Args:
+            zooms: Zoom levels to make tiles for.
+            format: "geojson", or "mvt" for Mapbox vector tiles (needs the mapbox-vector-tile package).
+            layer, extent: Name of the layer and size of the tile's grid, for vector tiles.
+        Returns the number of tiles written.
+        """
+        if format == "mvt":
+            import mapbox_vector_tile
+        written = 0
+        for zoom in zooms:
+            for (x, y), tile in self.tiles(zoom):
+                os.makedirs(os.path.join(folder, str(zoom), str(x)), exist_ok=True)
+                path = os.path.join(folder, str(zoom), str(x), f"{y}.{format}")
+                if format == "geojson":
+                    tile.save_geojson(path)
+                else:
+                    # Vector tiles want points on the tile's own grid, with y going up
+                    tile_x, tile_y = _mercator(tile.lat, tile.lon, zoom)
+                    px = np.round((tile_x - x) * extent).astype(int).tolist()
+                    py = np.round((1 - (tile_y - y)) * extent).astype(int).tolist()
+                    features = [{"geometry": f"POINT({px[i]} {py[i]})", "properties": tile.properties(i)}
+                                for i in range(len(tile))]
+                    with open(path, "wb") as f:
+                        f.write(mapbox_vector_tile.encode([{"name": layer, "features": features}]))
+                written += 1
+        return written
+
+def haversine(lat, lon, lats, lons):
+    """ Distance in meters from a point to each of a set of points. """
+    lat, lon, lats, lons = np.radians(lat), np.radians(lon), np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+def _around(south, north, west, east, meters):
+    # Grows a bounding box by some meters on every side. Longitude degrees shrink away from the equator
+    lat_pad = meters / METERS_PER_DEGREE
+    lon_pad = lat_pad / max(math.cos(math.radians(max(abs(south), abs(north)))), 1e-6)
+    return south - lat_pad, west - lon_pad, north + lat_pad, east + lon_pad
+
+def _mercator(lat, lon, zoom):
+    # Position in tiles (IE 3.5 is the middle of tile 3) at a zoom level
+    n = 1 << zoom
+    lat = np.radians(np.clip(lat, -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT))
+    x = np.clip((np.asarray(lon) + 180) / 360 * n, 0, n - 1e-9)
+    y = np.clip((1 - np.arcsinh(np.tan(lat)) / np.pi) / 2 * n, 0, n - 1e-9)
+    return x, y
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Exports the scores from assess() as map tiles.")
+    parser.add_argument("scores", help="scores.json, or the folder it's in.")
+    parser.add_argument("output", help="Folder to write tiles to.")
+    parser.add_argument("--zoom", type=int, nargs="+", default=[14])
+    parser.add_argument("--format", choices=["geojson", "mvt"], default="geojson")
+    args = parser.parse_args()
+
+    results = Results.load(args.scores)
+    print(f"Wrote {results.export_tiles(args.output, args.zoom, args.format)} tiles for {len(results)} stops")
@@ -1,16 +1,33 @@
 """
 For sending requests 
 """
-import requests
-from streetview import Pic, POI, Coord
+from streetview import Pic, POI, Coord, POIBatch, dump_errors, load_errors
 from dataclasses import dataclass
 import math 
+import time
+import threading
+from contextlib import contextmanager, nullcontext
 from os import path
 
+# Rough cost of each endpoint in USD per request, going by Google's pricing for the first 100k a month. Metadata is free
+COSTS = {"streetview": .007, "metadata": 0., "nearbysearch": .032}
+
 class Requests:
-    def __init__(self, key: str, pic_dims, debug = False):
+    def __init__(self, key: str, pic_dims, debug = False, base_url="https://maps.googleapis.com", retries=0, 
+                 backoff=.5, tracker=None):
+        """
+        Args:
+            retries: Number of times to retry requests that fail from a server error, rate limiting or the connection.
+            backoff: Seconds to wait before the first retry. Doubles for every retry after that.
+            tracker: Tracker to record each request's timing in.
+        """
         self.key = key
         self.debug = debug
+        self.retries = retries
+        self.backoff = backoff
+        self.tracker = tracker if tracker else Tracker(enabled=False)
+        # Where requests get sent. Point this at mock_maps.py to test without using up quota
+        self.base_url = base_url.rstrip("/")
         if pic_dims:
             self.pic_len = pic_dims[0]
             self.pic_height = pic_dims[1]
@@ -36,7 +53,9 @@ class Requests:
             params = pic_params,
             context = "Pulling image",
             coords = repr(pic.coords),
-            base = 'https://maps.googleapis.com/maps/api/streetview?')
+            base = f'{self.base_url}/maps/api/streetview?',
+            endpoint = "streetview",
+            poi_id = poi.id)
         
         # Handle errors
         if type(response) == Error:
@@ -62,9 +81,11 @@ class Requests:
         # Pull a response 
         response = self._pull_response(
             params = params,
-            base = 'https://maps.googleapis.com/maps/api/place/nearbysearch/json',
+            base = f'{self.base_url}/maps/api/place/nearbysearch/json',
             context = "Pulling nearby search results",
-            coords=poi.coords)
+            coords=poi.coords,
+            endpoint="nearbysearch",
+            poi_id=poi.id)
         
         # Handle errors
         if type(response) == Error:
@@ -100,7 +121,9 @@ class Requests:
             params=params,
             coords=repr(pic.coords),
             context="Pulling metadata",
-            base='https://maps.googleapis.com/maps/api/streetview/metadata?')
+            base=f'{self.base_url}/maps/api/streetview/metadata?',
+            endpoint="metadata",
+            poi_id=poi.id)
         
         # Handle errors
         if type(response) == Error: 
@@ -114,31 +137,88 @@ class Requests:
         pic.date = response.json().get("date")
         response.close()
 
-    def _pull_response(self, params, context, base, coords):
+    def _pull_response(self, params, context, base, coords, endpoint=None, poi_id=None):
+        # Requests is slow to import, so wait until something actually gets sent
+        import requests
+
         # Print a sumamry of the request if debugging 
         if self.debug: print(f"[REQUEST] {context} for {coords}")
+        started, start = time.time(), time.perf_counter()
+
+        for attempt in range(self.retries + 1):
+            # Wait a bit longer before each retry
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+                if self.debug: print(f"[REQUEST] Retrying {context} for {coords}")
+            status, size = None, 0
+
+            # Issue request
+            try:
+                response = requests.get(base, params=params, timeout=10)
+            
+            # Catch any exceptions that are raised, return Error
+            except requests.exceptions.RequestException as e:
+                if self.debug: print(f"[ERROR] Got {e} when {context}!")
+                result = Error(context, repr(e))
+                continue
+
+            # Check the request's status code 
+            status, size = response.status_code, len(response.content)
+            if status == 200:
+                result = response
+                break
+
+            # Check for empty response 
+            if not response.content:
+                result = Error(context, "empty response")
+            
+            # Return error if the request was not successful
+            else:
+                response.close()
+                result = Error(context, f"({response.status_code}): {response.text}")
+
+            # Only server errors and rate limiting are worth retrying
+            if status < 500 and status != 429:
+                break
+
+        self.tracker.request(endpoint, poi_id, started, time.perf_counter() - start, size, status, retries=attempt)
+        return result
+
+class Tracker:
+    """
+    Buffers the timing of every request and every stage of capturing a stop, until the log writes them out in a batch.
+    Args:
+        enabled: Whether to record anything at all.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.requests = []
+        self.stages = []
+        self._lock = threading.Lock()
 
-        # Issue request
+    def request(self, endpoint, poi_id, started, latency, size, status, cache_hit=False, retries=0):
+        """ Records a request. started is a unix timestamp, latency is in seconds and size is in bytes. """
+        if self.enabled:
+            with self._lock:
+                self.requests.append((poi_id, endpoint, started, latency, size, status, int(cache_hit), retries))
+
+    @contextmanager
+    def stage(self, name, poi_id):
+        """ Times a with block as one of a stop's stages. """
+        started, start = time.time(), time.perf_counter()
         try:
-            response = requests.get(base, params=params, timeout=10)
-        
-        # Catch any exceptions that are raised, return Error
-        except requests.exceptions.RequestException as e:
-            if self.debug: print(f"[ERROR] Got {e} when {context}!")
-            return Error(context, repr(e))
-
-        # Check the request's status code 
-        if response.status_code == 200:
-            return response
-
-        # Check for empty response 
-        if not response.content:
-            return Error(context, "empty response")
-        
-        # Return error if the request was not successful
-        else:
-            response.close()
-            return Error(context, f"({response.status_code}): {response.text}")
+            yield
+        finally:
+            if self.enabled:
+                with self._lock:
+                    self.stages.append((poi_id, name, started, time.perf_counter() - start))
+
+    def drain(self):
+        """ Hands over everything recorded so far, then forgets it. """
+        with self._lock:
+            requests, self.requests = self.requests, []
+            stages, self.stages = self.stages, []
+        return requests, stages
 
 @dataclass
 class Error:
@@ -159,7 +239,7 @@ class Log:
     from csv import writer
     from os import remove
 
-    def __init__(self, folder_path:str):
+    def __init__(self, folder_path:str, tracker: Tracker = None):
         # Create or connect database 
         self.db_path = path.join(folder_path, "log.db")
         self.db_connect = self.sqlite3.connect(self.db_path)
@@ -190,23 +270,68 @@ class Log:
                 pic_lon REAL,
                 heading REAL,
                 date TEXT,
+                pano_id TEXT,
                 FOREIGN KEY (poi_id) REFERENCES pois (poi_id)
             )
             """)
 
+        # Logs from before pics kept their pano need the column added
+        columns = [row[1] for row in self.db_cursor.execute("PRAGMA table_info(pictures)").fetchall()]
+        if "pano_id" not in columns:
+            self.db_cursor.execute("ALTER TABLE pictures ADD COLUMN pano_id TEXT")
+        self.db_cursor.execute("CREATE INDEX IF NOT EXISTS pictures_poi ON pictures (poi_id)")
+
+        # Set up tables for instrumentation, IE how long each request and each stage of a stop took
+        self.tracker = tracker
+        self.db_cursor.execute("""
+            CREATE TABLE IF NOT EXISTS requests (
+                request_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                poi_id TEXT,
+                endpoint TEXT,
+                started REAL,
+                latency REAL,
+                bytes INTEGER,
+                status INTEGER,
+                cache_hit INTEGER,
+                retries INTEGER
+            )
+            """)
+        self.db_cursor.execute("""
+            CREATE TABLE IF NOT EXISTS stages (
+                stage_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                poi_id TEXT,
+                stage TEXT,
+                started REAL,
+                duration REAL
+            )
+            """)
+
         self.db_connect.commit()
 
     def commit_entry(self, poi: POI):
         """
         Stores POI and picture data in separate relational tables.
         """
-        # Insert or ignore POI data (to prevent duplicate inserts)
-        self.db_cursor.execute("""
-            INSERT INTO pois (poi_id, lat, lon, og_lat, og_lon, fov, place_name, place_id, errors)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(poi_id) DO UPDATE SET
-            fov=excluded.fov, errors=excluded.errors
-        """, (
+        if self.tracker:
+            with self.tracker.stage("log_commit", poi.id):
+                self._commit_entry(poi)
+        else:
+            self._commit_entry(poi)
+
+    # Insert or ignore POI data (to prevent duplicate inserts)
+    POI_INSERT = """
+        INSERT INTO pois (poi_id, lat, lon, og_lat, og_lon, fov, place_name, place_id, errors)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(poi_id) DO UPDATE SET
+        fov=excluded.fov, errors=excluded.errors
+    """
+    PIC_INSERT = """
+        INSERT INTO pictures (poi_id, pic_number, pic_lat, pic_lon, heading, date, pano_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """
+
+    def _commit_entry(self, poi: POI):
+        self.db_cursor.execute(self.POI_INSERT, (
             poi.id,
             poi.coords.lat,
             poi.coords.lon,
@@ -215,32 +340,116 @@ class Log:
             poi.fov,
             poi.place_name if poi.place_name else None, 
             poi.place_id if poi.place_id else None,
-            ",".join([repr(error) for error in poi.errors]) if poi.errors else None
+            dump_errors(poi.error_messages()) or None
         ))
 
-        # Insert entries for each of the POI's pics 
+        # Insert entries for each of the POI's pics, replacing any from an earlier commit of the same POI
+        self.db_cursor.execute("DELETE FROM pictures WHERE poi_id = ?", (poi.id,))
         for pic in poi.pics:
-            self.db_cursor.execute("""
-                INSERT INTO pictures (poi_id, pic_number, pic_lat, pic_lon, heading, date)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
+            self.db_cursor.execute(self.PIC_INSERT, (
                 poi.id,
                 pic.pic_number,
                 pic.coords.lat if pic.coords else None, 
                 pic.coords.lon if pic.coords else None,
                 pic.heading if pic.coords else None,
-                pic.date if pic.date else None
+                pic.date if pic.date else None,
+                pic.pano_id if pic.pano_id else None
             ))
 
+        # Write out whatever's been tracked since the last entry in the same transaction
+        self._insert_tracked()
+        self.db_connect.commit()
+
+    def commit_batch(self, batch: POIBatch):
+        """ Same as commit_entry() for every POI in a POIBatch, but all in one go. """
+        # NaNs and empty strings are how the batch says something's missing
+        null = lambda column: [None if value != value or value == "" else value for value in column.tolist()]
+        with (self.tracker.stage("log_commit", None) if self.tracker else nullcontext()):
+            self.db_cursor.executemany(self.POI_INSERT, zip(
+                batch.id.tolist(), batch.lat.tolist(), batch.lon.tolist(), null(batch.og_lat), null(batch.og_lon), 
+                null(batch.fov), null(batch.place_name), null(batch.place_id.astype(str)), null(batch.errors)))
+            self.db_cursor.executemany("DELETE FROM pictures WHERE poi_id = ?", ((id,) for id in batch.id.tolist()))
+            self.db_cursor.executemany(self.PIC_INSERT, zip(
+                batch.id[batch.poi].tolist(), batch.pic_number.tolist(), null(batch.pic_lat), null(batch.pic_lon), 
+                null(batch.heading), null(batch.date.astype(str)), null(batch.pano_id.astype(str))))
+            self._insert_tracked()
+            self.db_connect.commit()
+
+    def _insert_tracked(self):
+        # Batch insert everything the tracker has buffered
+        if not self.tracker:
+            return
+        requests, stages = self.tracker.drain()
+        self.db_cursor.executemany("""
+            INSERT INTO requests (poi_id, endpoint, started, latency, bytes, status, cache_hit, retries)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, requests)
+        self.db_cursor.executemany("""
+            INSERT INTO stages (poi_id, stage, started, duration) VALUES (?, ?, ?, ?)
+        """, stages)
+
+    def summary(self):
+        """
+        Sums up the tracked requests and stages. Use it to find what's slow and to estimate what a city will cost.
+        Returns a dict with:
+            requests: For each endpoint, the count, cache hits, failures, retries, bytes, latency (mean, p50 and p99 
+                in seconds) and estimated cost in USD. Cache hits and failures aren't billed.
+            stages: For each stage, the count, total seconds and mean, p50 and p99 seconds.
+            pois: Number of POIs logged.
+            cost_per_poi: Estimated cost in USD of each POI.
+        """
+        self._insert_tracked()
         self.db_connect.commit()
 
+        # Tally up requests 
+        requests = {}
+        for endpoint, count, hits, failed, retries, size in self.db_cursor.execute("""
+            SELECT endpoint, COUNT(*), SUM(cache_hit), SUM(status IS NOT 200), SUM(retries), SUM(bytes)
+            FROM requests GROUP BY endpoint
+        """).fetchall():
+            requests[endpoint] = {"count": count, "cache_hits": hits, "failed": failed, "retries": retries, 
+                                  "bytes": size, "cost": COSTS.get(endpoint, 0.) * (count - hits - failed)}
+        for endpoint in requests:
+            latencies = self._column("SELECT latency FROM requests WHERE endpoint IS ? AND cache_hit = 0", endpoint)
+            requests[endpoint].update(_spread(latencies))
+
+        # Tally up stages 
+        stages = {}
+        for (stage,) in self.db_cursor.execute("SELECT DISTINCT stage FROM stages").fetchall():
+            durations = self._column("SELECT duration FROM stages WHERE stage = ?", stage)
+            stages[stage] = {"count": len(durations), "total": sum(durations), **_spread(durations)}
+
+        pois = self.db_cursor.execute("SELECT COUNT(*) FROM pois").fetchone()[0]
+        cost = sum(endpoint["cost"] for endpoint in requests.values())
+        return {"requests": requests, "stages": stages, "pois": pois, "cost_per_poi": cost / pois if pois else 0.}
+
+    def report(self):
+        """ Prints summary() in a readable format. """
+        summary = self.summary()
+        print(f"[LOG] {summary['pois']} POIs, ~${summary['cost_per_poi']:.4f} each")
+        for endpoint, row in summary["requests"].items():
+            print(f"[LOG] {endpoint}: {row['count']} requests ({row['cache_hits']} cached, {row['failed']} failed, "
+                  f"{row['retries']} retries), p50 {row['p50'] * 1000:.0f}ms, p99 {row['p99'] * 1000:.0f}ms, "
+                  f"{row['bytes'] / 1e6:.1f}MB, ${row['cost']:.2f}")
+        for stage, row in summary["stages"].items():
+            print(f"[LOG] {stage}: {row['total']:.1f}s total, p50 {row['p50'] * 1000:.0f}ms, "
+                  f"p99 {row['p99'] * 1000:.0f}ms")
+
+    def _column(self, query, *params):
+        return sorted(row[0] for row in self.db_cursor.execute(query, params).fetchall())
+
     def write_log(self, folder_path, name="log", delete_db=True):
         # Derive log 
         log_path = path.join(folder_path, f"{name}.json")
 
+        # Save a summary of the instrumentation next to it, since the database might get deleted
+        if self.tracker:
+            with open(path.join(folder_path, f"{name}_stats.json"), "w", encoding="utf-8") as statsfile:
+                self.json.dump(self.summary(), statsfile, indent=4)
+
         # Query to fetch all POIs with corresponding Pics
         self.db_cursor.execute("""
-            SELECT pois.*, pictures.pic_number, pictures.pic_lat, pictures.pic_lon, pictures.heading, pictures.date
+            SELECT pois.*, pictures.pic_number, pictures.pic_lat, pictures.pic_lon, pictures.heading, pictures.date, pictures.pano_id
             FROM pois
             LEFT JOIN pictures ON pois.poi_id = pictures.poi_id
         """)
@@ -264,7 +473,7 @@ class Log:
                     "fov": entry.pop("fov"),
                     "place_id": entry.pop("place_id"),
                     "place_name": entry.pop("place_name"),
-                    "errors": entry.pop("errors").split(",") if entry.get("errors") else [],
+                    "errors": load_errors(entry.pop("errors")),
                     "pictures": []
                 }
 
@@ -275,7 +484,8 @@ class Log:
                     "pic_lat": entry.pop("pic_lat"),
                     "pic_lon": entry.pop("pic_lon"),
                     "heading": entry.pop("heading"),
-                    "date": entry.pop("date")
+                    "date": entry.pop("date"),
+                    "pano_id": entry.pop("pano_id")
                 }
                 poi_dict[poi_id]["pictures"].append(pic_entry)
 
@@ -288,6 +498,13 @@ class Log:
         if delete_db:
             self.remove(self.db_path)
 
+def _spread(values):
+    """ Mean, median and 99th percentile of a sorted list. """
+    if not values:
+        return {"mean": 0., "p50": 0., "p99": 0.}
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {"mean": sum(values) / len(values), "p50": pick(.5), "p99": pick(.99)}
+
 class Misc:
     def estimate_heading(pic: Pic, poi: POI):
         """
@@ -2,8 +2,16 @@ from PIL import Image
 from io import BytesIO
 from dataclasses import dataclass, asdict
 from os import makedirs, path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import queue
+import numpy as np
+import json
+import time
 
-@dataclass
+# Coords, Pics and POIs are slotted since a city's worth of them adds up. Use POIBatch for really big runs
+@dataclass(slots=True)
 class Coord:
     """
     Represents a coordinate pair. 
@@ -17,7 +25,7 @@ class Coord:
     def __repr__(self):
         return f"{self.lat},{self.lon}"
 
-@dataclass
+@dataclass(slots=True)
 class Pic:
     """ Represents pictues, of which there can be multiple for a given POI. You 
     Probably don't need to interact with these. """
@@ -37,6 +45,31 @@ class Pic:
         dict.pop('coords', None)
         return dict
 
+def pic_key(pano_id: str, heading: float, fov: float, stitch=(0, 0), heading_step=5):
+    """
+    Key for a picture request that doesn't change for pics that would come back (near) identical,
+    IE multipoint pics that snapped onto the same pano, with headings within a few degrees.
+    Args:
+        heading_step: Headings are rounded to the nearest multiple of this (in degrees).
+    """
+    heading = round(heading / heading_step) * heading_step % 360 if heading is not None else None
+    return (pano_id, heading, fov, tuple(stitch))
+
+def dhash(img: Image.Image, size=8):
+    """ 
+    Perceptual (difference) hash of an image, for spotting duplicates of pics that were pulled by location instead of pano.
+    Returns an int with size*size bits.
+    """
+    # Let the JPEG decoder do most of the shrinking, then compare each pixel to its neighbor 
+    img.draft("L", (size * 8, size * 8))
+    pixels = list(img.convert("L").resize((size + 1, size)).getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            i = row * (size + 1) + col
+            bits = (bits << 1) | (pixels[i] > pixels[i + 1])
+    return bits
+
 class POI:
     """ A Point of Interest to capture pictures of.
     Attributes: 
@@ -46,6 +79,8 @@ class POI:
         keyword: The search criteria used when improving coordinates through the Maps API. 
         coord_pair: Strips the longitude and latitude from a coordinate pair
     """
+    __slots__ = ("coords", "id", "keyword", "fov", "errors", "pics", "original_coords", "place_name", "place_id")
+
     def __init__(self, lat:float, lon:float, id, keyword="bus stop"):
         # Create coord object to contain coords
         self.coords = Coord(lat, lon)
@@ -60,30 +95,183 @@ class POI:
         self.place_name = None
         self.place_id = None
 
+    def error_messages(self):
+        """ The POI's errors as strings. Errors that were read back in from a log are already strings. """
+        return [error if isinstance(error, str) else repr(error) for error in self.errors]
+
+def dump_errors(messages):
+    """ Packs a list of error messages into one string for a column. Empty if there aren't any. """
+    return json.dumps(messages) if messages else ""
+
+def load_errors(text):
+    """ Unpacks a column's string back into error messages. Logs from before errors were JSON get one big message. """
+    if not text:
+        return []
+    try:
+        messages = json.loads(text)
+    except ValueError:
+        return [text]
+    return messages if isinstance(messages, list) else [text]
+
+class POIBatch:
+    """
+    Lots of POIs and their pics, stored as columns of numpy arrays instead of as objects. Made for city-sized runs, 
+    and for handing off to vectorized code. Index it to get one POI back as an object, or iterate over it for all of them.
+    Attributes:
+        id, lat, lon, og_lat, og_lon, fov, place_name, place_id, keyword, errors: One row per POI. 
+            og_lat/og_lon are NaN if the POI's coords weren't improved. Errors are one JSON list per POI (see dump_errors).
+        poi, pic_number, pic_lat, pic_lon, heading, stitch_clock, stitch_counter, pano_id, date: One row per pic, 
+            grouped by POI. poi is the index of the pic's POI.
+        starts: The row each POI's pics start at, plus one on the end for where the last one stops.
+    Missing numbers are NaN and missing strings are "". Pano IDs and dates are always ASCII, so they're kept 
+    as bytes (a quarter of the size of numpy's str).
+    """
+    POI_COLUMNS = {"id": str, "lat": np.float64, "lon": np.float64, "og_lat": np.float64, "og_lon": np.float64, 
+                   "fov": np.float32, "place_name": object, "place_id": str, "keyword": object, "errors": object}
+    PIC_COLUMNS = {"poi": np.int32, "pic_number": np.int16, "pic_lat": np.float64, "pic_lon": np.float64, 
+                   "heading": np.float64, "stitch_clock": np.int8, "stitch_counter": np.int8, "pano_id": bytes, 
+                   "date": bytes}
+
+    def __init__(self, pois: dict, pics: dict):
+        """ Takes a dict of lists or arrays for each POI column and each pic column. Use from_pois() or from_log(). """
+        for name, dtype in {**self.POI_COLUMNS, **self.PIC_COLUMNS}.items():
+            values = pois[name] if name in self.POI_COLUMNS else pics[name]
+            setattr(self, name, np.asarray(values, dtype=dtype) if len(values) else np.empty(0, dtype))
+        self.starts = np.searchsorted(self.poi, np.arange(len(self.id) + 1))
+
+    @classmethod
+    def from_pois(cls, pois):
+        """ Packs POI objects into a batch. """
+        pois = list(pois)
+        og = [poi.original_coords for poi in pois]
+        pics = [(i, pic) for i, poi in enumerate(pois) for pic in poi.pics]
+        return cls({
+            "id": [str(poi.id) for poi in pois],
+            "lat": [poi.coords.lat for poi in pois],
+            "lon": [poi.coords.lon for poi in pois],
+            "og_lat": [coords.lat if coords else np.nan for coords in og],
+            "og_lon": [coords.lon if coords else np.nan for coords in og],
+            "fov": [_nan(poi.fov) for poi in pois],
+            "place_name": [poi.place_name or "" for poi in pois],
+            "place_id": [poi.place_id or "" for poi in pois],
+            "keyword": [poi.keyword for poi in pois],
+            "errors": [dump_errors(poi.error_messages()) for poi in pois],
+        }, {
+            "poi": [i for i, _ in pics],
+            "pic_number": [pic.pic_number for _, pic in pics],
+            "pic_lat": [pic.coords.lat if pic.coords else np.nan for _, pic in pics],
+            "pic_lon": [pic.coords.lon if pic.coords else np.nan for _, pic in pics],
+            "heading": [_nan(pic.heading) for _, pic in pics],
+            "stitch_clock": [pic.stitch_clock for _, pic in pics],
+            "stitch_counter": [pic.stitch_counter for _, pic in pics],
+            "pano_id": [pic.pano_id or "" for _, pic in pics],
+            "date": [pic.date or "" for _, pic in pics],
+        })
+
+    @classmethod
+    def from_log(cls, stops: dict, keyword="bus stop"):
+        """ Reads the stops from a log.json (IE json.load-ed) into a batch. """
+        ids = list(stops)
+        pics = [(i, pic) for i, id in enumerate(ids) for pic in stops[id]["pictures"]]
+        column = lambda name, default=np.nan: [_nan(stops[id][name], default) for id in ids]
+        pic_column = lambda name, default=np.nan: [_nan(pic.get(name), default) for _, pic in pics]
+        return cls({
+            "id": ids, "lat": column("lat"), "lon": column("lon"), "og_lat": column("og_lat"), 
+            "og_lon": column("og_lon"), "fov": column("fov"), "place_name": column("place_name", ""), 
+            "place_id": column("place_id", ""), "keyword": [keyword] * len(ids),
+            "errors": [dump_errors(stops[id]["errors"]) for id in ids],
+        }, {
+            "poi": [i for i, _ in pics], "pic_number": pic_column("pic_number", 0), "pic_lat": pic_column("pic_lat"), 
+            "pic_lon": pic_column("pic_lon"), "heading": pic_column("heading"), 
+            "stitch_clock": pic_column("stitch_clock", 0), "stitch_counter": pic_column("stitch_counter", 0), 
+            "pano_id": pic_column("pano_id", ""), "date": pic_column("date", ""),
+        })
+
+    @classmethod
+    def concat(cls, batches):
+        """ Joins batches end to end. """
+        batches = list(batches)
+        offsets = np.cumsum([0] + [len(batch) for batch in batches])
+        pois = {name: np.concatenate([getattr(batch, name) for batch in batches]) if batches else []
+                for name in cls.POI_COLUMNS}
+        pics = {name: np.concatenate([getattr(batch, name) for batch in batches]) if batches else []
+                for name in cls.PIC_COLUMNS}
+        if batches:
+            pics["poi"] = np.concatenate([batch.poi + offset for batch, offset in zip(batches, offsets)])
+        return cls(pois, pics)
+
+    def __len__(self):
+        return len(self.id)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getitem__(self, i) -> POI:
+        """ Unpacks one POI, pics and all. Errors come back as strings. """
+        poi = POI(float(self.lat[i]), float(self.lon[i]), str(self.id[i]), self.keyword[i])
+        if not np.isnan(self.og_lat[i]):
+            poi.original_coords = Coord(float(self.og_lat[i]), float(self.og_lon[i]))
+        poi.fov = _none(self.fov[i])
+        poi.place_name = self.place_name[i] or None
+        poi.place_id = str(self.place_id[i]) or None
+        poi.errors = load_errors(self.errors[i])
+        for j in range(self.starts[i], self.starts[i + 1]):
+            coords = Coord(float(self.pic_lat[j]), float(self.pic_lon[j])) if not np.isnan(self.pic_lat[j]) else None
+            poi.pics.append(Pic(int(self.pic_number[j]), _none(self.heading[j]), int(self.stitch_clock[j]), 
+                                int(self.stitch_counter[j]), coords, self.pano_id[j].decode() or None, 
+                                self.date[j].decode() or None))
+        return poi
+
+    def pics_of(self, i):
+        """ Slice of the pic columns that belongs to the ith POI. """
+        return slice(self.starts[i], self.starts[i + 1])
+
+def _nan(value, default=np.nan):
+    # Stand-in for missing values in POIBatch's columns
+    return default if value is None else value
+
+def _none(value):
+    # Turn POIBatch's NaNs back into None
+    return None if np.isnan(value) else float(value)
+
 class Session:
-    from services import Requests, Log, Misc
+    from services import Requests, Log, Misc, Tracker
 
     def __init__(self, folder_path: str, key_path="key.txt", pic_dims=(640, 640), 
-                 debug=False, logging=True):
+                 debug=False, logging=True, dedupe_size=256, base_url="https://maps.googleapis.com", 
+                 retries=0, instrument=True):
         # Store folder path and create it if it doesn't exist
         self.folder_path = folder_path
         if not path.exists(self.folder_path):
             makedirs(self.folder_path)
 
+        # Keeps track of how long requests and each stage of a stop take. Hand it to Autoincrement too
+        self.tracker = self.Tracker(enabled=instrument and logging)
+
         # Set up requests session
         self.requests = self.Requests(key = open(key_path, "r").read(),
                                       debug=debug, 
-                                      pic_dims=pic_dims)
+                                      pic_dims=pic_dims,
+                                      base_url=base_url,
+                                      retries=retries,
+                                      tracker=self.tracker)
         # Set up log session
         if logging: 
-            self.log = self.Log(folder_path)
+            self.log = self.Log(folder_path, self.tracker)
 
         # Variables
         self.debug = debug
         self.pic_dims = pic_dims
-        self.place_ids = []
+        # Places already pulled, for verify_unique. Resolving can happen from several threads at once
+        self.place_ids = set()
+        self._place_lock = threading.Lock()
+
+        # Recently pulled images, keyed by pic_key(), so that pics of the same pano and heading are only pulled once
+        self.dedupe_size = dedupe_size
+        self.recent = OrderedDict()
+        self._recent_lock = threading.Lock()
     
-    def capture_POI(self, poi:POI, fov = 85, heading:float=None, stitch = (0,0)):
+    def capture_POI(self, poi:POI, fov = 85, heading:float=None, stitch = (0,0), save=True, pics=None, commit=True):
         """
         Capture image(s) of a POI. 
         Pass the POI into the multipoint class first if you're trying to capture multiple vantage points of the POI! 
@@ -93,7 +281,11 @@ class Session:
             fov (int): The field of view for all images 
             heading (float): The angle that the picture will be taken at, in degrees. Leave as None to automatically estimate. 
             stitch (int, int): Number of images to be stitched to the primary one. A tuple of (num imgs to add clockwise, counterclockwise) 
+            save (bool): Whether to save the images to the session's folder. 
+            pics (list): Only capture these of the POI's pics, IE ones added since it was last captured. Defaults to all of them.
+            commit (bool): Whether to write the POI to the log. Turn off if more pics are going to be captured later. 
 
+        Returns the captured PIL images, in the same order as the pics.
         """
         # Check and update FOV 
         if 120 < fov < 10: 
@@ -101,36 +293,216 @@ class Session:
             return
         poi.fov = fov
 
-        # Handle multipoint capturing if the POI already has Pics
-        if poi.pics:
-            # Warn if heading is provided when multipointing
-            if heading: 
-                print("[WARNING] Inputted heading is overriden by the multipoint function!")
-            
-            # Capture each pic
-            for pic in poi.pics: 
-                self._capture_pic(poi, pic)
-
-        # Otherwise, build a new pic object and capture it 
-        else: 
-            # Build pic, add to POI
-            pic = Pic(heading=heading, stitch_clock=stitch[0], stitch_counter=stitch[1], coords=poi.coords)
-            poi.pics.append(pic)
-
-            # Estimate heading if none is provided 
-            if heading == None:
-                self.requests.pull_pano_info(pic)
-                self.Misc.estimate_heading(pic, poi)
-            
-            # Pull pic 
-            self._capture_pic(poi, pic)
+        with self.tracker.stage("capture", poi.id):
+            # Handle multipoint capturing if the POI already has Pics
+            if poi.pics:
+                # Warn if heading is provided when multipointing
+                if heading: 
+                    print("[WARNING] Inputted heading is overriden by the multipoint function!")
+                
+                # Capture each pic
+                imgs = [self._capture_pic(poi, pic, save) for pic in (poi.pics if pics is None else pics)]
+
+            # Otherwise, build a new pic object and capture it 
+            else: 
+                # Build pic, add to POI
+                pic = Pic(heading=heading, stitch_clock=stitch[0], stitch_counter=stitch[1], coords=poi.coords)
+                poi.pics.append(pic)
+
+                # Estimate heading if none is provided 
+                if heading == None:
+                    self.requests.pull_pano_info(pic, poi)
+                    self.Misc.estimate_heading(pic, poi)
+                
+                # Pull pic 
+                imgs = [self._capture_pic(poi, pic, save)]
         
         # Write this POI's entry/entries into the log 
-        self.log.commit_entry(poi)
+        if commit:
+            self.log.commit_entry(poi)
+        return imgs
+
+    def capture_batch(self, batch: POIBatch, spacer=None, num_points=(1, 1), fov=85, save=True, improve=False, 
+                      commit_every=256):
+        """
+        Captures every POI in a POIBatch, returning a new batch of them with their pics. 
+        Only one chunk of POIs is ever held as objects, and each chunk goes into the log in one go.
+        Args:
+            spacer: A multipoint Autoincrement to find vantage points with. Without one, each POI gets a single pic 
+                (unless it already has some).
+            num_points: Vantage points before and after the main one, passed to the spacer.
+            fov, save: Passed to capture_POI().
+            improve: Whether to improve each POI's coords first. POIs that can't be improved are skipped, 
+                same as pull_imgs().
+            commit_every: Number of POIs per chunk.
+        """
+        done, chunk = [], []
+        def flush():
+            # Pack the chunk back into columns and log it
+            done.append(POIBatch.from_pois(chunk))
+            if hasattr(self, "log"):
+                self.log.commit_batch(done[-1])
+            chunk.clear()
+
+        for poi in batch:
+            if improve and not self.improve_coords(poi):
+                continue
+            if spacer:
+                spacer.determine_points(poi, num_points)
+            self.capture_POI(poi, fov, save=save, commit=False)
+            chunk.append(poi)
+            if len(chunk) >= commit_every:
+                flush()
+        if chunk:
+            flush()
+        return POIBatch.concat(done)
+
+    def capture_pipelined(self, pois, spacer=None, num_points=(1, 1), min_interval=5, fov=85, save=True, improve=True, 
+                          verify_unique=False, workers=(4, 4, 8), max_pending=64):
+        """
+        Captures POIs in stages that each run in their own pool of threads, with their own queue: 
+        resolving the POI (nearby search), planning its pics (the multipoint metadata walk) and pulling each pic's image.
+        Every stage keeps working on whatever's ready, so slow metadata walks don't hold up images for stops that are 
+        already planned. POIs are written to the log from this thread, since sqlite connections can't be shared.
+        Yields each POI, its images (in the same order as its pics) and when it started, as soon as it's done. 
+        They won't necessarily come out in the same order they went in.
+        Args:
+            pois: Any iterable of POIs, IE a POIBatch. Only pulled from as there's room.
+            spacer: A multipoint Autoincrement to plan pics with. Without one, each POI gets a single pic.
+            num_points, min_interval: Passed to the spacer.
+            fov, save: Same as capture_POI().
+            improve, verify_unique: Whether to improve each POI's coords first, and whether to skip POIs that turn out 
+                to be a place we've already pulled (see improve_coords()). POIs that can't be improved are skipped too.
+            workers: Number of threads for resolving, planning and pulling images.
+            max_pending: Most POIs in the pipeline at once. Keeps memory in check if the stages are lopsided.
+        """
+        done = queue.Queue()
+        resolvers, planners, fetchers = (ThreadPoolExecutor(n) for n in workers)
+
+        def resolve(poi, start):
+            if improve and not self.improve_coords(poi, verify_unique):
+                done.put((poi, None, start))
+            else:
+                planners.submit(guard, plan, poi, start)
+
+        def plan(poi, start):
+            poi.fov = fov
+            if spacer:
+                spacer.determine_points(poi, num_points, min_interval)
+            if not poi.pics:
+                pic = Pic(coords=poi.coords)
+                poi.pics.append(pic)
+                self.requests.pull_pano_info(pic, poi)
+                self.Misc.estimate_heading(pic, poi)
+
+            # Every pic gets pulled on its own, the last one to finish hands the POI over
+            imgs, left = [None] * len(poi.pics), [len(poi.pics)]
+            lock = threading.Lock()
+            for i, pic in enumerate(poi.pics):
+                fetchers.submit(guard, fetch, poi, start, pic, i, imgs, left, lock)
+
+        def fetch(poi, start, pic, i, imgs, left, lock):
+            try:
+                with self.tracker.stage("capture", poi.id):
+                    imgs[i] = self._capture_pic(poi, pic, save)
+            finally:
+                with lock:
+                    left[0] -= 1
+                    finished = not left[0]
+                if finished:
+                    done.put((poi, imgs, start))
+
+        def guard(stage, poi, start, *args):
+            # Anything that goes wrong finishes the POI early, with whatever error came up 
+            try:
+                stage(poi, start, *args)
+            except Exception as e:
+                poi.errors.append(e)
+                if self.debug: print(f"[ERROR] Got {e!r} when capturing {poi.id}!")
+                if stage is not fetch:
+                    done.put((poi, [], start))
+
+        try:
+            pois, pending = iter(pois), 0
+            while True:
+                # Top up the pipeline
+                while pending < max_pending:
+                    poi = next(pois, None)
+                    if poi is None:
+                        break
+                    resolvers.submit(guard, resolve, poi, time.perf_counter())
+                    pending += 1
+                if not pending:
+                    break
+
+                # Log whatever's done 
+                poi, imgs, start = done.get()
+                pending -= 1
+                if imgs is None:
+                    continue
+
+                # Drop pics whose image never came through, so the log only lists images that exist. 
+                # Why they failed is already in the POI's errors
+                kept = [(pic, img) for pic, img in zip(poi.pics, imgs) if img is not None]
+                poi.pics, imgs = [pic for pic, _ in kept], [img for _, img in kept]
+                if hasattr(self, "log"):
+                    self.log.commit_entry(poi)
+                yield poi, imgs, start
+        finally:
+            for pool in (resolvers, planners, fetchers):
+                pool.shutdown(wait=True, cancel_futures=True)
+
+    def refresh_POI(self, poi: POI, save=True, commit=True):
+        """
+        Checks the metadata of each of a POI's pics again (IE ones read from an old log with POIBatch.from_log), 
+        only pulling a pic's image again if the pano there has changed, IE it has a different pano ID or capture date.
+        Pics from logs that predate pano IDs are compared by date alone, and just get the pano ID filled in if it matches. 
+        Pics that never had their metadata pulled will always look changed. 
+        Args:
+            save: Whether to save the new images, overwriting the old ones.
+            commit: Whether to write the POI back into the log.
+        Returns the pics that were pulled again.
+        """
+        poi.fov = poi.fov or 85
+        changed = []
+        with self.tracker.stage("refresh", poi.id):
+            for pic in poi.pics:
+                # See what's at the pic's pano now. Keep the old one if we can't tell
+                fresh = Pic(pic.pic_number, stitch_clock=pic.stitch_clock, stitch_counter=pic.stitch_counter, 
+                            coords=pic.coords)
+                self.requests.pull_pano_info(fresh, poi)
+                if fresh.pano_id is None or (fresh.pano_id == pic.pano_id and fresh.date == pic.date):
+                    continue
+
+                # Older logs didn't keep the pano ID, so go by the date and just fill the ID in if that still matches
+                if pic.pano_id is None and pic.date is not None and fresh.date == pic.date:
+                    pic.pano_id = fresh.pano_id
+                    continue
+
+                # Aim at the POI from the new pano and pull it
+                self.Misc.estimate_heading(fresh, poi)
+                self._capture_pic(poi, fresh, save)
+                pic.coords, pic.heading, pic.pano_id, pic.date = fresh.coords, fresh.heading, fresh.pano_id, fresh.date
+                changed.append(pic)
+
+        if commit:
+            self.log.commit_entry(poi)
+        return changed
+
+    def _capture_pic(self, poi: POI, pic: Pic, save=True):
+        # See if we've just pulled this same image for another pic. Can only tell if we know the pano
+        key = pic_key(pic.pano_id, pic.heading, poi.fov, (pic.stitch_clock, pic.stitch_counter))
+        with self._recent_lock:
+            cached = self.recent.get(key) if pic.pano_id else None
+            if cached is not None:
+                self.recent.move_to_end(key)
+        if cached is not None:
+            final_img = cached.copy()
+            self.tracker.request("streetview", poi.id, time.time(), 0., 0, 200, cache_hit=True)
+            if self.debug: print(f"[REQUEST] Reusing image of pano {pic.pano_id} for {poi.id}")
 
-    def _capture_pic(self, poi: POI, pic: Pic):
         # Handle image stitching 
-        if pic.stitch_clock or pic.stitch_counter:
+        elif pic.stitch_clock or pic.stitch_counter:
             # Object to store the images in (as arrays) before stitching 
             imgs = []
             start_heading = pic.heading - (pic.stitch_counter * poi.fov)
@@ -153,12 +525,21 @@ class Session:
 
             # Open as PIL image
             final_img = Image.open(BytesIO(img))
-        
-        # Base pic name on POI ID and its number 
-        image_path = path.join(self.folder_path, f"{poi.id}_{pic.pic_number}.jpg")
 
-        # Save the image
-        final_img.save(image_path)
+        # Remember it in case another pic needs the same image, forgetting the oldest if there's too many
+        # Decode it now so that other threads can copy it without tripping over each other
+        if pic.pano_id and self.dedupe_size and cached is None:
+            final_img.load()
+            with self._recent_lock:
+                self.recent[key] = final_img
+                if len(self.recent) > self.dedupe_size:
+                    self.recent.popitem(last=False)
+        
+        # Base pic name on POI ID and its number, save the image
+        if save:
+            image_path = path.join(self.folder_path, f"{poi.id}_{pic.pic_number}.jpg")
+            final_img.save(image_path)
+        return final_img
 
     def _stitch_images(self, imgs):
         # Convert to PIL images
@@ -182,9 +563,11 @@ class Session:
         Args:
             poi: The point of interest that needs to have its coords improved.
             verify_unique: Ensure that this place hasn't been pulled before. 
+        Returns True if the coords were improved (and it's a new place, if verify_unique).
         """
         # Find nearest google maps 'business' of type keyword 
-        nearest = self.requests.pull_closest(poi) 
+        with self.tracker.stage("improve_coords", poi.id):
+            nearest = self.requests.pull_closest(poi) 
         
         # Get the location from the results
         if nearest:
@@ -202,11 +585,13 @@ class Session:
         poi.place_name = nearest['name']
         poi.place_id = nearest['place_id']
         if verify_unique:
-            if poi.place_id in self.place_ids:
+            with self._place_lock:
+                seen = poi.place_id in self.place_ids
+                self.place_ids.add(poi.place_id)
+            if seen:
                 if self.debug: print(f"[WARNING] POI with ID {poi.id} has been pulled before, skipping!")
                 return False
-            self.place_ids.append(poi.place_name)
-            return True
+        return True
 
     def write_log(self, name="log", delete_db=True):
         """
@@ -0,0 +1,154 @@
+"""
+A cache of images that have already been decoded and letterboxed for the model, so that repeat runs (IE trying out
+other weights or thresholds) don't have to decode every JPEG again. Everything lives in one memory-mapped file of
+640x640 BGR uint8 images next to the log, with an index keyed by (POI ID, pic number).
+Takes about 1.2MB of disk per image.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import json
+import os
+
+# Names of the files the cache is kept in, next to the log
+DATA_FILE = "tensors.u8"
+INDEX_FILE = "tensors.json"
+
+# Same gray that ultralytics pads with
+PAD_COLOR = 114
+
+def letterbox(img, size=640, out=None):
+    """
+    Shrinks (or grows) a BGR image to fit in a size x size square, centered and padded with gray.
+    Args:
+        out: Array to write the result into, IE a row of the cache. A new one is made if not provided.
+    Returns the result and its (x, y) padding and scale. A box in the result is at (box - pad) / scale in the original.
+    """
+    import cv2
+    if out is None:
+        out = np.empty((size, size, 3), np.uint8)
+    height, width = img.shape[:2]
+    scale = min(size / height, size / width)
+    new_width, new_height = round(width * scale), round(height * scale)
+    pad_x, pad_y = (size - new_width) // 2, (size - new_height) // 2
+
+    # Most streetview pics are already the right size, so only resize and pad if needed
+    if (new_width, new_height) != (width, height):
+        img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    if (new_width, new_height) != (size, size):
+        out[:] = PAD_COLOR
+    out[pad_y:pad_y + new_height, pad_x:pad_x + new_width] = img
+    return out, pad_x, pad_y, scale
+
+class TensorCache:
+    """
+    Letterboxed images stored in one memory-mapped file. Reading an image out of it is a view, not a copy.
+    Args:
+        folder: Folder to keep the cache in, IE the one with the log and images.
+        size: Width and height of the letterboxed images.
+        readonly: Open the cache without being able to add to it, IE from worker processes.
+    """
+    def __init__(self, folder:str, size=640, readonly=False):
+        self.folder = folder
+        self.size = size
+        self.readonly = readonly
+        self.data = None
+        self.capacity = 0
+
+        # Each entry is (row, file size, file mtime, x padding, y padding, scale), keyed by (POI ID, pic number)
+        self.entries = {}
+        self.count = 0
+
+        # Rows that aren't being used anymore, IE because an image stopped decoding. New images go in them first
+        self.free = []
+        index_path = os.path.join(folder, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            # Start over if the images were a different size
+            if index["size"] == size:
+                self.count = index["count"]
+                self.free = index.get("free", [])
+                self.entries = {(poi_id, pic): tuple(entry) for poi_id, pic, *entry in index["entries"]}
+        self._map(self.count)
+
+    def _map(self, capacity):
+        # (Re)open the data file with room for at least this many images
+        path = os.path.join(self.folder, DATA_FILE)
+        row_bytes = self.size * self.size * 3
+        if not self.readonly:
+            if not os.path.exists(path):
+                open(path, "wb").close()
+            if os.path.getsize(path) < capacity * row_bytes:
+                with open(path, "r+b") as f:
+                    f.truncate(capacity * row_bytes)
+        self.capacity = os.path.getsize(path) // row_bytes if os.path.exists(path) else 0
+        self.data = np.memmap(path, np.uint8, "r" if self.readonly else "r+",
+                              shape=(self.capacity, self.size, self.size, 3)) if self.capacity else None
+
+    def update(self, stops:dict, input_folder:str, workers=4):
+        """
+        Adds the images of every pic in a log's stops (or some of them) that are new or have changed on disk.
+        Decoding happens across a pool of threads. Call save() afterwards to keep them for the next run.
+        Returns the number of images added.
+        """
+        # Work out which images need (re)doing, giving new ones a free row or else the next one on the end
+        todo = []
+        for stop_id in stops:
+            for pic in stops[stop_id]["pictures"]:
+                path = f"{input_folder}/{stop_id}_{pic['pic_number']}.jpg"
+                if not os.path.exists(path):
+                    continue
+                stat = os.stat(path)
+                key = (str(stop_id), int(pic["pic_number"]))
+                entry = self.entries.get(key)
+                if entry and entry[1:3] == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                if entry:
+                    row = entry[0]
+                elif self.free:
+                    row = self.free.pop()
+                else:
+                    row = self.count
+                    self.count += 1
+                todo.append((key, path, row, stat))
+
+        # Grow the file by half again when it runs out, so that adding a few at a time doesn't remap every time
+        if self.count > self.capacity:
+            self._map(max(self.count, self.capacity * 3 // 2))
+
+        # Decode straight into the cache's rows
+        def load(job):
+            import cv2
+            key, path, row, stat = job
+            img = cv2.imread(path)
+            if img is None:
+                return key, row, None
+            _, pad_x, pad_y, scale = letterbox(img, self.size, self.data[row])
+            return key, row, (row, stat.st_size, stat.st_mtime_ns, pad_x, pad_y, scale)
+
+        # Rows of images that couldn't be decoded get handed back
+        with ThreadPoolExecutor(workers) as pool:
+            for key, row, entry in pool.map(load, todo):
+                if entry:
+                    self.entries[key] = entry
+                else:
+                    self.entries.pop(key, None)
+                    self.free.append(row)
+        return len(todo)
+
+    def get(self, poi_id, pic_number):
+        """ Returns a view of a pic's letterboxed image, plus its (x padding, y padding, scale). None if it isn't cached. """
+        entry = self.entries.get((str(poi_id), int(pic_number)))
+        if entry is None or entry[0] >= self.capacity:
+            return None
+        return self.data[entry[0]], entry[3:]
+
+    def save(self):
+        """ Writes the images to disk, then the index. """
+        if self.data is not None:
+            self.data.flush()
+        path = os.path.join(self.folder, INDEX_FILE)
+        with open(f"{path}.part", "w") as f:
+            json.dump({"size": self.size, "count": self.count, "free": self.free,
+                       "entries": [[*key, *entry] for key, entry in self.entries.items()]}, f)
+        os.replace(f"{path}.part", path)